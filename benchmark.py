@@ -0,0 +1,159 @@
+# benchmark.py
+# 可复现的基准测试：生成合成规则语料，在本地DNS桩服务器上运行完整流程，分别报告各阶段的吞吐量
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+from loguru import logger
+from dispose import RuleParser, MASK_CHINA_VALID, MASK_VALID, MASK_CN
+from fake_dns import serve_forever
+from merge_rules import normalize_rule_line
+from metrics import peak_rss_mb
+from config import GEOIP_DB_FILE
+
+TLDS = ["com", "net", "org", "cn", "io", "xyz", "top", "info"]
+
+
+def make_corpus(path, lines, seed=0):
+    """
+    生成合成规则语料，混合各类常见写法：
+    ||域名^、||域名、@@||域名^、@@||域名^$important、正则规则（含匹配任意子域名的写法）、hosts 写法，以及父子域名重复的规则。
+    每行先经 merge_rules.normalize_rule_line 规范化，与 dispose.py 实际读到的 beforeall.txt 一致。
+    返回生成的规则行数。
+    """
+    rng = random.Random(seed)
+    bases = []
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("! Title: benchmark corpus\n")
+        f.write(f"! Seed: {seed}\n")
+        for i in range(lines):
+            kind = rng.random()
+            if bases and kind < 0.15:
+                domain = f"sub{i}.{rng.choice(bases)}"  # 被上级规则覆盖的子域名
+            else:
+                domain = f"bench{i}.site{rng.randrange(lines // 4 + 1)}.{rng.choice(TLDS)}"
+                if len(bases) < 4096:
+                    bases.append(domain)
+            if kind < 0.55:
+                rule = f"||{domain}^"
+            elif kind < 0.65:
+                rule = f"||{domain}"
+            elif kind < 0.75:
+                rule = f"@@||{domain}^"
+            elif kind < 0.80:
+                rule = f"@@||{domain}^$important"
+            elif kind < 0.825:
+                rule = f"/^ad{i}[0-9]*\\.{rng.choice(TLDS)}$/"
+            elif kind < 0.85:
+                # 覆盖 siteN.tld 及其全部子域名的正则，其覆盖的域名规则会在解析前被剪除
+                rule = f"/^(\\S+\\.)?site{rng.randrange(lines // 4 + 1)}\\.{rng.choice(TLDS)}$/"
+            elif kind < 0.95:
+                rule = f"0.0.0.0 {domain}"
+            else:
+                rule = f"||{domain}^$dnstype=AAAA"
+            for normalized in normalize_rule_line(rule):
+                f.write(normalized + "\n")
+    return lines
+
+
+def run_pipeline(engine, corpus, workdir, port, processes, geoip_db_file):
+    """
+    在 workdir 下以引擎命名的新子目录中用指定引擎运行 parse_rules + filter_valid_rules，返回 (RuleParser, 各阶段耗时)。
+    每个引擎使用独立的目录，不会把其他引擎生成的 all*.txt 当作上次的输出（沿用结论和变更报告都以其为基准）。
+    """
+    engine_dir = os.path.join(workdir, engine)
+    os.makedirs(engine_dir)
+    cwd = os.getcwd()
+    os.chdir(engine_dir)  # all-lite.txt 等输出文件写在当前目录
+    try:
+        parser = RuleParser(corpus, "all.txt", dns_engine=engine, dns_processes=processes,
+                            china_nameservers=["127.0.0.1"], global_nameservers=["127.0.0.1"],
+                            dns_port=port, geoip_db_file=geoip_db_file)
+        parser.parse_rules()
+        parser.filter_valid_rules()
+    finally:
+        os.chdir(cwd)
+    return parser, dict(parser.stage_times)
+
+
+def throughput_report(parser, stage_times, lines):
+    """按阶段换算吞吐量：解析按行数，DNS按查询的域名数（两个DNS阶段同时进行，均从流水线开始时计时），GeoIP按域名数，写入按规则数"""
+    china_count = parser.domain_count()
+    global_count = china_count - parser.count_domains(MASK_CHINA_VALID)
+    units = {
+        "parse": (lines, "行"),
+        "china_dns": (china_count, "域名"),
+        "global_dns": (global_count, "域名"),
+        "geoip": (len(parser.ip_table), "域名"),
+        "write_lite": (len(parser.valid_rules), "规则"),
+        "write": (len(parser.valid_rules), "规则"),
+    }
+    report = {}
+    for stage, seconds in stage_times.items():
+        count, unit = units.get(stage, (0, ""))
+        report[stage] = {
+            "seconds": round(seconds, 4), "items": count, "unit": unit,
+            "per_second": round(count / seconds, 1) if seconds > 0 else None,
+        }
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="在本地DNS桩服务器上对完整流程进行可复现的基准测试")
+    arg_parser.add_argument("--lines", type=int, default=100000, help="合成语料的行数")
+    arg_parser.add_argument("--latency", type=float, default=0.005, help="桩服务器的平均响应延迟（秒）")
+    arg_parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential"], default="fixed",
+                            help="响应延迟的分布")
+    arg_parser.add_argument("--nxdomain-ratio", type=float, default=0.5, help="返回 NXDOMAIN 的域名比例")
+    arg_parser.add_argument("--drop-rate", type=float, default=0.0, help="桩服务器随机丢弃查询的比例")
+    arg_parser.add_argument("--engines", nargs="+", default=["dnspython", "udp"], help="参与比较的引擎")
+    arg_parser.add_argument("--processes", type=int, default=1, help="多进程分片解析的进程数")
+    arg_parser.add_argument("--seed", type=int, default=0, help="语料和桩服务器的随机种子")
+    arg_parser.add_argument("--geoip-db", default=GEOIP_DB_FILE, help="GeoIP数据库文件")
+    arg_parser.add_argument("--output", help="将结果保存为 JSON 文件")
+    args = arg_parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve_forever, args=(port_queue,),
+        kwargs={"latency": args.latency, "latency_dist": args.latency_dist, "nxdomain_ratio": args.nxdomain_ratio,
+                "drop_rate": args.drop_rate, "seed": args.seed},
+        daemon=True,
+    )
+    server.start()
+    port = port_queue.get()
+
+    results = {"lines": args.lines, "latency": args.latency, "latency_dist": args.latency_dist,
+               "nxdomain_ratio": args.nxdomain_ratio, "drop_rate": args.drop_rate, "processes": args.processes,
+               "seed": args.seed, "engines": {}}
+    geoip_db_file = os.path.abspath(args.geoip_db)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            corpus = os.path.join(workdir, "beforeall.txt")
+            make_corpus(corpus, args.lines, args.seed)
+            for engine in args.engines:
+                parser, stage_times = run_pipeline(engine, corpus, workdir, port, args.processes, geoip_db_file)
+                report = throughput_report(parser, stage_times, args.lines)
+                valid_count, cn_count = parser.count_domains(MASK_VALID), parser.count_domains(MASK_CN)
+                # 峰值内存为进程启动以来的最大值，多个引擎依次运行时后面的引擎报告的是累计峰值
+                results["engines"][engine] = {"valid_domains": valid_count, "cn_domains": cn_count,
+                                              "peak_rss_mb": peak_rss_mb()[0], "stages": report}
+                for stage, item in report.items():
+                    logger.info(f"引擎 {engine}（{args.processes}个进程）阶段 {stage}: {item['items']}个{item['unit']}"
+                                f"耗时{item['seconds']:.2f}秒，{item['per_second'] or 0:.0f}个{item['unit']}/秒。")
+                logger.info(f"引擎 {engine}: 有效域名{valid_count}个，关联中国IP的域名{cn_count}个，"
+                            f"峰值内存{peak_rss_mb()[0]}MB。")
+    finally:
+        server.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+        logger.info(f"基准测试结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
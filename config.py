@@ -16,3 +16,78 @@ OUTPUT_FILE = "beforeall.txt"
 
 # 本地规则文件路径
 LOCAL_RULE_FILE = "white.txt"  # 新增本地规则文件路径
+
+# 上游规则下载
+SOURCE_CACHE_DIR = "source_cache"  # 上游规则正文及 ETag/Last-Modified 缓存目录
+DOWNLOAD_TIMEOUT = 60  # 单个上游下载超时时间（秒）
+DOWNLOAD_MAX_CONNECTIONS = 8  # 并发下载的最大连接数
+
+# 规则合并：规范化后的规则在内存中累积到该数量时，排序写入临时文件，最后多路归并生成输出文件
+MERGE_MAX_RULES_IN_MEMORY = 500000
+
+# DNS 服务器
+CHINA_NAMESERVERS = ["119.29.29.29", "223.6.6.6", "180.184.1.1"]  # 国内DNS
+GLOBAL_NAMESERVERS = ["1.1.1.1", "8.8.8.8", "9.9.9.9"]  # 国外DNS
+DNS_PORT = 53
+
+# 解析工作池（每个DNS服务器独立的 AIMD 自适应并发窗口）
+DNS_POOL_INITIAL_WORKERS = 64  # 每个DNS服务器的初始并发数
+DNS_POOL_MIN_WORKERS = 8  # 每个DNS服务器的最小并发数
+DNS_POOL_MAX_WORKERS = 512  # 每个DNS服务器的最大并发数
+DNS_POOL_INCREASE = 8  # 上游表现良好时每个统计窗口增加的并发数
+DNS_POOL_DECREASE = 0.5  # 上游开始丢包时并发数的缩减倍数
+DNS_POOL_WINDOW = 200  # 每统计多少次查询调整一次并发数
+DNS_POOL_FAILURE_THRESHOLD = 0.05  # 超时和 SERVFAIL 比例超过该值时缩减并发数
+
+# 对冲查询与单域名时间预算：首个DNS服务器超过对冲延迟仍未应答时，向另一个服务器发出相同查询，取先到的成功结果；
+# 超过时间预算仍无结果的域名记为超时，超时和 SERVFAIL 视为结论未知，沿用上次的输出结果而不是直接剔除
+DNS_DOMAIN_BUDGET = 5.0  # 单个域名的解析时间预算（秒）
+DNS_QUERY_TIMEOUT = 2.0  # dnspython 引擎单次查询的超时时间（秒）
+DNS_HEDGE_PERCENTILE = 0.95  # 对冲延迟取该DNS服务器成功应答延迟的分位数
+DNS_HEDGE_MIN_DELAY = 0.05  # 对冲延迟下限（秒）
+DNS_HEDGE_INITIAL_DELAY = 0.5  # 样本不足时的对冲延迟（秒）
+
+# DNS 查询引擎: "dnspython" 使用 dnspython 的异步解析器（先查 A，失败后再查 AAAA）；
+# "udp" 使用 udp_resolver.py 中的原始 UDP 批量引擎（A/AAAA 并行查询）
+DNS_ENGINE = "dnspython"
+UDP_SOCKETS_PER_NAMESERVER = 4  # udp 引擎每个DNS服务器使用的长连接套接字数
+UDP_QUERY_TIMEOUT = 1.0  # udp 引擎单次查询的重传间隔（秒）
+UDP_QUERY_RETRIES = 3  # udp 引擎单个查询的最大发送次数
+
+# 多进程分片解析：大于 1 时按域名哈希把待解析域名分给多个进程，每个进程运行独立的事件循环和解析器。
+# 每个进程各自维护 AIMD 并发窗口，对同一DNS服务器的总并发约为进程数乘以单进程窗口。
+DNS_PROCESSES = 1
+DNS_SHARD_MIN_DOMAINS = 20000  # 待解析域名少于该值时不启用多进程
+DNS_SHARD_BATCH_SIZE = 1000  # 子进程每解析多少个域名向主进程回传一次结果
+# 国内与国外DNS解析以流水线方式同时进行，国内DNS未能解析的域名每攒够该数量即交给国外DNS解析。
+# 启用多进程时两个阶段各自启动 DNS_PROCESSES 个解析进程。
+DNS_PIPELINE_BATCH_SIZE = 500
+
+# GeoIP 数据库（GeoIP2-CN），用于生成 all-cn.txt
+GEOIP_DB_FILE = "Country.mmdb"
+
+# 增量模式：按每个域名的历史决定是否复查，其余沿用快照中的结论。
+# 新增域名、结论刚变化过的域名和结论尚未稳定的域名每次都复查；连续得出相同结论的域名，复查间隔从 INCREMENTAL_BASE_INTERVAL_DAYS 起
+# 按 2 的幂次延长，最长 INCREMENTAL_MAX_INTERVAL_DAYS。每次运行最多重新解析 INCREMENTAL_DOMAIN_BUDGET 个域名
+# （按上述优先级选取，同一类中上次复查越早越优先，为 0 时不限），超出预算的域名沿用上次的输出结果，留待下次运行。
+INCREMENTAL_MODE = True
+SNAPSHOT_FILE = "snapshot.json.gz"  # 上次运行的域名集合、解析结论与复查历史快照
+INCREMENTAL_DOMAIN_BUDGET = 30000  # 每次运行最多重新解析的域名数
+INCREMENTAL_FLAPPING_STREAK = 3  # 连续相同结论少于该次数的域名视为结论尚未稳定，每次都复查
+INCREMENTAL_BASE_INTERVAL_DAYS = 1  # 稳定域名的初始复查间隔（天）
+INCREMENTAL_MAX_INTERVAL_DAYS = 30  # 稳定域名的最长复查间隔（天）
+INCREMENTAL_RECHECK_TOLERANCE_HOURS = 6  # 判断复查是否到期时允许提前的小时数，定时任务比前一天略早触发时不会推迟一个周期
+DELTA_REPORT_FILE = "delta_report.json"  # 各输出文件相对上次新增/删除规则的报告
+
+# 运行指标
+METRICS_FILE = "dispose_metrics.json"  # 各阶段耗时和各DNS服务器查询指标，与 dispose.log 放在一起
+
+# 规则查询索引：为每个输出规则文件生成同名的二进制索引（如 all.idx），可由 rule_index.RuleIndex 直接 mmap 加载；
+# 设为空字符串时不生成
+RULE_INDEX_SUFFIX = ".idx"
+
+# 断点续跑：运行中各阶段每个域名的解析结论追加写入该目录，运行中断后重新运行时跳过已有结论的域名，
+# 输出与不中断时一致；运行正常结束后删除该目录
+JOURNAL_DIR = "dispose_journal"
+JOURNAL_FLUSH_SIZE = 2000  # 每攒够多少条结论写入一次
+JOURNAL_FLUSH_INTERVAL = 10  # 距上次写入超过该秒数时也写入一次
@@ -1,28 +1,90 @@
 import os
 import re
 import asyncio
+import json
+import multiprocessing
+import queue
+import time
+import zlib
 from loguru import logger
+import dns.exception
+import dns.resolver
 from dns.asyncresolver import Resolver as DNSResolver
 from dns.rdatatype import RdataType as DNSRdataType
 from datetime import datetime, timezone, timedelta
-import geoip2.database
+from array import array
+from domain_trie import DomainTrie
+from regex_rules import RegexRuleMatcher
+from rule_index import build_index
+from dns_pool import AIMDLimiter, DNSWorkerPool, FAILURE_STATUSES
+from udp_resolver import UDPResolver
+from geoip_index import CountryIPIndex
+from domain_ip_table import DomainIPTable
+from recheck_scheduler import plan_rechecks, update_history, is_conclusive
+from resolve_journal import ResolveJournal, input_fingerprint
+from metrics import NameserverMetrics, merge_nameserver_metrics, build_report, save_report, peak_rss_mb
+from snapshot import (load_snapshot, save_snapshot, FLAG_CHINA_CHECKED, FLAG_CHINA_VALID,
+                      FLAG_GLOBAL_CHECKED, FLAG_GLOBAL_VALID)
+from config import (CHINA_NAMESERVERS, GLOBAL_NAMESERVERS, DNS_PORT,
+                    DNS_POOL_INITIAL_WORKERS, DNS_POOL_MIN_WORKERS, DNS_POOL_MAX_WORKERS,
+                    DNS_POOL_INCREASE, DNS_POOL_DECREASE, DNS_POOL_WINDOW, DNS_POOL_FAILURE_THRESHOLD,
+                    DNS_DOMAIN_BUDGET, DNS_QUERY_TIMEOUT, DNS_HEDGE_PERCENTILE, DNS_HEDGE_MIN_DELAY,
+                    DNS_HEDGE_INITIAL_DELAY,
+                    DNS_ENGINE, UDP_SOCKETS_PER_NAMESERVER, UDP_QUERY_TIMEOUT, UDP_QUERY_RETRIES,
+                    DNS_PROCESSES, DNS_SHARD_MIN_DOMAINS, DNS_SHARD_BATCH_SIZE, DNS_PIPELINE_BATCH_SIZE, GEOIP_DB_FILE,
+                    INCREMENTAL_MODE, SNAPSHOT_FILE, INCREMENTAL_DOMAIN_BUDGET, INCREMENTAL_FLAPPING_STREAK,
+                    INCREMENTAL_BASE_INTERVAL_DAYS, INCREMENTAL_MAX_INTERVAL_DAYS, INCREMENTAL_RECHECK_TOLERANCE_HOURS,
+                    DELTA_REPORT_FILE,
+                    METRICS_FILE, RULE_INDEX_SUFFIX, JOURNAL_DIR, JOURNAL_FLUSH_SIZE, JOURNAL_FLUSH_INTERVAL)
+
+# 域名状态位图中的标志位
+MASK_CHINA_VALID = 1  # 国内DNS解析成功，写入 all-lite.txt
+MASK_VALID = 2  # 国内或国外DNS解析成功，写入 all.txt
+MASK_CN = 4  # 关联中国IP，写入 all-cn.txt
+MASK_ALL = MASK_CHINA_VALID | MASK_VALID | MASK_CN  # 不需要域名解析的规则
 
 class RuleParser:
-    def __init__(self, input_file, output_file):
+    def __init__(self, input_file, output_file, dns_engine=DNS_ENGINE, dns_processes=DNS_PROCESSES,
+                 incremental=False, snapshot_file=SNAPSHOT_FILE, china_nameservers=CHINA_NAMESERVERS,
+                 global_nameservers=GLOBAL_NAMESERVERS, dns_port=DNS_PORT, geoip_db_file=GEOIP_DB_FILE,
+                 journal_dir=None):
         self.input_file = input_file
         self.output_file = output_file
+        self.china_nameservers = china_nameservers  # 国内DNS
+        self.global_nameservers = global_nameservers  # 国外DNS
+        self.dns_port = dns_port
+        self.geoip_db_file = geoip_db_file
+        self.journal_dir = journal_dir  # 断点续跑日志目录，为 None 时不记录
+        self.journal = None  # 本次运行的断点续跑日志 (ResolveJournal)
+        self.version_time = None  # 输出文件的版本时间，续跑时沿用中断前的值以保证输出一致
+        self.stage_times = {}  # 各阶段耗时（秒）: parse / china_dns / write_lite / global_dns / geoip / write，两个DNS阶段均从流水线开始时计时
+        self.stage_peak_rss = {}  # 各阶段结束时本进程的峰值常驻内存 (MB)
+        self.delta_files = {}  # 变更报告中各输出文件相对上次新增/删除的规则
+        self.dns_metrics = {}  # 各解析阶段的DNS服务器指标 {阶段 -> {DNS服务器 -> NameserverMetrics}}
+        self.dns_engine = dns_engine  # DNS查询引擎: "dnspython" 或 "udp"
+        self.dns_processes = dns_processes  # 多进程分片解析的进程数，1 表示在当前进程中解析
+        self.incremental = incremental  # 是否启用增量模式
+        self.snapshot_file = snapshot_file  # 增量模式使用的快照文件
+        self.snapshot_state = None  # 上次快照 {域名 -> (标志位, 逗号分隔的IP地址, 结论, 连续相同结论次数, 上次复查时间)}，非增量模式或无快照时为 None
+        self.recheck_domains = set()  # 增量模式下需要重新解析的域名（由复查调度按历史和预算选出）
+        self.run_time = int(time.time())  # 本次运行的时间，记为复查时间
         self.valid_rules = []  # 存储有效的规则
-        self.domain_set = set()  # 存储提取的域名
+        self.rule_domain_ids = array("i")  # 与 valid_rules 一一对应的域名编号，-1 表示规则不含域名
+        self.domain_ids = {}  # 域名 -> 编号
+        self.domain_names = []  # 按编号存储的域名，剪除冗余规则后重新编号，只保留仍被规则引用的域名
+        self.domain_masks = bytearray()  # 按域名编号存储的状态位图 (MASK_*)
+        self.unknown_masks = bytearray()  # 按域名编号存储的结论未知位图 (MASK_*)，超时或 SERVFAIL 的域名沿用上次的输出结果
+        self.resolve_flags = bytearray()  # 按域名编号存储的解析结论 (snapshot.FLAG_*)，国内和国外DNS的结果直接写入其中
+        self.answered_flags = bytearray()  # 按域名编号存储本次由DNS服务器实际应答得出结论的阶段 (FLAG_*_CHECKED)，不含沿用快照的结论
+        self.ip_table = DomainIPTable(0)  # 按域名编号存储解析到的IP地址
         self.total_rules = 0  # 总规则数量
-        self.valid_domains = set()  # 存储最终有效的域名 (A或AAAA解析成功)
+        self.pruned_rules = 0  # 被上级域名规则覆盖的冗余规则数量
+        self.covered_rules = {}  # 被上级域名规则覆盖的子域名规则序号 -> 上级纯黑名单规则序号元组
+        self.regex_pruned_rules = 0  # 被正则规则覆盖而剪除的冗余规则数量
+        self.regex_saved_domains = 0  # 因正则规则覆盖而无需解析的域名数量
         self.header_comments = []  # 存储开头的注释行
         self.has_header_been_collected = False  # 标记是否已经收集过注释行
         self.seen_comments = set()  # 用于存储已经出现过的注释行
-        # --- Modified/New Attributes ---
-        self.ipv4_set = set() # 存储所有解析成功的IPv4地址 (用于GeoIP查询)
-        self.domain_to_ip_map = {} # 存储 域名 -> {ipv4_set} 的映射
-        self.cn_domains = set() # 存储确定位于中国的域名
-        # --- End Modified/New Attributes ---
 
     def __parse_line(self, line):
         """解析单行规则，提取域名"""
@@ -54,8 +116,15 @@ class RuleParser:
                 return line, domain
         return None, None  # 无效规则
 
+    def __record_stage(self, stage, start):
+        """记录某阶段从 start 开始到现在的耗时"""
+        self.stage_times[stage] = time.perf_counter() - start
+        self.stage_peak_rss[stage] = peak_rss_mb()[0]
+        logger.info(f"阶段 {stage} 耗时{self.stage_times[stage]:.2f}秒，峰值内存{self.stage_peak_rss[stage]}MB。")
+
     def parse_rules(self):
         """解析规则文件并提取域名"""
+        stage_start = time.perf_counter()
         with open(self.input_file, "r", encoding="utf-8") as f:
             for line in f:
                 if line.startswith("!") and not self.has_header_been_collected:  # 只收集一次注释行
@@ -69,243 +138,673 @@ class RuleParser:
                     rule, domain = self.__parse_line(line)
                     if rule is not None:  # 如果是有效规则
                         self.valid_rules.append(rule)
-                        if domain:
-                            self.domain_set.add(domain)
-        logger.info(f"解析完成，共找到{len(self.valid_rules)}条有效规则和{len(self.domain_set)}个唯一域名。")
+                        self.rule_domain_ids.append(self.__intern_domain(domain))
+        logger.info(f"解析完成，共找到{len(self.valid_rules)}条有效规则和{self.domain_count()}个唯一域名。")
+        self.__prune_redundant_rules()
+        self.__record_stage("parse", stage_start)
+
+    def __intern_domain(self, domain):
+        """返回域名的编号，首次出现时分配新编号；无域名时返回 -1"""
+        if domain is None:
+            return -1
+        domain_id = self.domain_ids.get(domain)
+        if domain_id is None:
+            domain_id = len(self.domain_names)
+            self.domain_ids[domain] = domain_id
+            self.domain_names.append(domain)
+        return domain_id
+
+    def __renumber_domains(self):
+        """只为仍被规则引用的域名重新编号，并按域名数量分配状态位图和IP地址表"""
+        domain_ids = {}
+        domain_names = []
+        rule_domain_ids = array("i")
+        for domain_id in self.rule_domain_ids:
+            if domain_id >= 0:
+                domain = self.domain_names[domain_id]
+                domain_id = domain_ids.get(domain)
+                if domain_id is None:
+                    domain_id = domain_ids[domain] = len(domain_names)
+                    domain_names.append(domain)
+            rule_domain_ids.append(domain_id)
+        self.domain_ids, self.domain_names, self.rule_domain_ids = domain_ids, domain_names, rule_domain_ids
+        self.domain_masks = bytearray(len(domain_names))
+        self.unknown_masks = bytearray(len(domain_names))
+        self.resolve_flags = bytearray(len(domain_names))
+        self.answered_flags = bytearray(len(domain_names))
+        self.ip_table = DomainIPTable(len(domain_names))
+
+    def domain_count(self):
+        """需要解析的唯一域名数（不含空域名）"""
+        return sum(1 for domain in self.domain_names if domain)
+
+    def count_domains(self, flag):
+        """状态位图中带有 flag 的域名数"""
+        return sum(1 for mask in self.domain_masks if mask & flag)
+
+    def __prune_redundant_rules(self):
+        """
+        处理被上级黑名单规则覆盖的子域名黑名单规则（如已有 ||example.com^ 时的 ||a.b.example.com^），
+        以及被正则黑名单规则完全覆盖的黑名单规则（如已有 /^(\S+\.)?[0-9a-f]{15,}\.com$/ 时的 ||0123456789abcdef.com^）。
+        只处理不带修饰符的纯域名规则；若域名本身或其上级被白名单规则放行，则保留该规则。
+        正则规则写入所有输出文件，被其覆盖的规则直接剪除；上级域名规则可能因解析失败而不写入某个文件，
+        被其覆盖的子域名规则仍参与解析，记入 covered_rules，写入时只在上级规则已写入的文件中剪除。
+        """
+        plain_domain = re.compile(r"[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)*")
+        block_trie = DomainTrie()  # 纯黑名单规则的域名
+        allow_trie = DomainTrie()  # 白名单规则的域名
+        block_domains = {}  # 规则 -> 域名，仅包含可参与剪除的纯黑名单规则
+        rule_domains = {}  # 域名 -> 引用该域名的规则数量
+        domains = self.domain_names
+        for rule, domain_id in zip(self.valid_rules, self.rule_domain_ids):
+            domain = domains[domain_id] if domain_id >= 0 else None
+            if not domain:
+                continue
+            rule_domains[domain] = rule_domains.get(domain, 0) + 1
+            if rule.startswith("@@||"):
+                if plain_domain.fullmatch(domain):
+                    allow_trie.add(domain)
+            elif plain_domain.fullmatch(domain):
+                block_trie.add(domain)
+                block_domains[rule] = domain
+
+        # 正则规则不含域名（编号为 -1），批量找出被正则黑名单规则覆盖的纯黑名单域名
+        regex_matcher = RegexRuleMatcher(rule for rule, domain_id in zip(self.valid_rules, self.rule_domain_ids)
+                                         if domain_id < 0)
+        regex_covered = regex_matcher.match_domains(set(block_domains.values()))
+
+        domain_count = self.domain_count()
+        kept_rules = []
+        kept_domain_ids = array("i")
+        block_rule_indexes = {}  # 域名 -> 保留的纯黑名单规则在 kept_rules 中的序号
+        covered = []  # (子域名规则序号, 覆盖它的上级域名列表)
+        for rule, domain_id in zip(self.valid_rules, self.rule_domain_ids):
+            domain = block_domains.get(rule)
+            if domain is not None and not allow_trie.covers(domain, include_self=True):
+                parents = block_trie.ancestors(domain)
+                # 上级域名被正则规则覆盖时，正则同样覆盖其子域名，与被正则直接覆盖一样可以剪除
+                if parents and any(parent in regex_covered for parent in parents):
+                    self.pruned_rules += 1
+                    rule_domains[domain] -= 1
+                    continue
+                if domain in regex_covered:
+                    self.regex_pruned_rules += 1
+                    rule_domains[domain] -= 1
+                    if rule_domains[domain] == 0:
+                        self.regex_saved_domains += 1
+                    continue
+                if parents:
+                    self.pruned_rules += 1
+                    covered.append((len(kept_rules), parents))
+            if domain is not None:
+                block_rule_indexes.setdefault(domain, []).append(len(kept_rules))
+            kept_rules.append(rule)
+            kept_domain_ids.append(domain_id)
+
+        # 子域名规则 -> 上级纯黑名单规则的序号，写入时只在上级规则已写入的文件中剪除子域名规则
+        self.covered_rules = {index: tuple(parent_index for parent in parents
+                                           for parent_index in block_rule_indexes.get(parent, ()))
+                              for index, parents in covered}
+
+        self.valid_rules = kept_rules
+        self.rule_domain_ids = kept_domain_ids
+        self.__renumber_domains()
+        logger.info(f"子域名冗余检查完成，共{self.pruned_rules}条规则被上级域名规则覆盖，"
+                    f"其中{len(self.covered_rules)}条在写入时只从上级规则已写入的文件中剪除。")
+        logger.info(f"正则覆盖剪除完成，{regex_matcher.usable}/{regex_matcher.total}条正则规则参与判断，"
+                    f"共剪除{self.regex_pruned_rules}条被正则规则覆盖的规则，减少{self.regex_saved_domains}个待解析域名"
+                    f"（占{self.regex_saved_domains / max(domain_count, 1) * 100:.2f}%）。")
+        logger.info(f"剪除后剩余{len(self.valid_rules)}条规则和{self.domain_count()}个唯一域名。")
+
+    @staticmethod
+    def __classify_error(error):
+        """将 dnspython 异常归类为查询状态: nxdomain / empty / timeout / servfail / error"""
+        if isinstance(error, dns.resolver.NXDOMAIN):
+            return "nxdomain"
+        if isinstance(error, dns.resolver.NoAnswer):
+            return "empty"
+        if isinstance(error, dns.exception.Timeout):
+            return "timeout"
+        if isinstance(error, dns.resolver.NoNameservers):
+            return "servfail"
+        return "error"
 
     async def __resolve(self, dnsresolver, domain):
         """
         异步解析域名，获取IP地址（支持 A 和 AAAA 记录）。
-        返回: (bool: 是否解析成功 A 或 AAAA, set: 解析到的IPv4地址集合)
+        返回: (bool: 是否解析成功 A 或 AAAA, set: 解析到的IPv4地址集合, set: 解析到的IPv6地址集合,
+               int: 记录TTL，无记录时为 None, str: 查询状态 ok/nxdomain/empty/timeout/servfail/error)
         """
         resolved_ipv4s = set()
+        resolved_ipv6s = set()
         is_valid = False
+        ttl = None
+        statuses = []
         try:
             # 尝试解析 A 记录（IPv4）
             query_object_a = await dnsresolver.resolve(qname=domain, rdtype="A")
             is_valid = True # A记录解析成功即认为域名有效
+            ttl = query_object_a.rrset.ttl
             for item in query_object_a.response.answer:
                 if item.rdtype == DNSRdataType.A:
                     for rdata in item:
                         resolved_ipv4s.add(rdata.address) # 存储IPv4地址
-        except Exception:
-            pass # A记录解析失败或无记录
+        except Exception as e:
+            statuses.append(self.__classify_error(e)) # A记录解析失败或无记录
 
-        if not is_valid: # 只有当A记录未解析成功时，才尝试AAAA记录来判断有效性
+        if not is_valid and "timeout" not in statuses: # 只有当A记录未解析成功且上游未超时时，才尝试AAAA记录来判断有效性
             try:
                 # 尝试解析 AAAA 记录（IPv6）
                 query_object_aaaa = await dnsresolver.resolve(qname=domain, rdtype="AAAA")
                 for item in query_object_aaaa.response.answer:
                     if item.rdtype == DNSRdataType.AAAA:
                         is_valid = True # AAAA记录解析成功也认为域名有效
-                        break # 找到一个AAAA即可
-            except Exception:
-                pass # AAAA记录解析失败或无记录
-
-        return is_valid, resolved_ipv4s
+                        ttl = item.ttl
+                        for rdata in item:
+                            resolved_ipv6s.add(rdata.address) # 存储IPv6地址，仅有IPv6的域名也能参与GeoIP判断
+                if not is_valid:
+                    statuses.append("empty")
+            except Exception as e:
+                statuses.append(self.__classify_error(e)) # AAAA记录解析失败或无记录
 
-    async def __pingx(self, dnsresolver, domain, semaphore):
+        if is_valid:
+            status = "ok"
+        else:
+            # 以最严重的失败原因作为查询状态：上游故障优先于域名本身不存在
+            status = next((s for s in ("timeout", "servfail", "error", "nxdomain") if s in statuses), "empty")
+        return is_valid, resolved_ipv4s, resolved_ipv6s, ttl, status
+
+    async def __resolve_udp(self, udpresolver, domain):
+        """使用原始 UDP 引擎解析域名，返回值与 __resolve 相同"""
+        return await udpresolver.resolve(domain)
+
+    @staticmethod
+    def __new_dnspython_resolver(nameserver, port):
+        """创建只指向单个DNS服务器的 dnspython 异步解析器"""
+        dnsresolver = DNSResolver(configure=False)
+        dnsresolver.nameservers = [nameserver]  # 设置DNS服务器
+        dnsresolver.port = port
+        dnsresolver.timeout = DNS_QUERY_TIMEOUT
+        dnsresolver.lifetime = DNS_QUERY_TIMEOUT  # 不等待默认的较长超时，慢的上游交给工作池对冲
+        return dnsresolver
+
+    @staticmethod
+    def __new_udp_resolver(nameserver, port):
+        """创建只指向单个DNS服务器的原始 UDP 解析器"""
+        return UDPResolver(nameserver, port, UDP_SOCKETS_PER_NAMESERVER, UDP_QUERY_TIMEOUT, UDP_QUERY_RETRIES)
+
+    @staticmethod
+    def __new_limiter():
+        """为单个DNS服务器创建 AIMD 并发窗口"""
+        return AIMDLimiter(DNS_POOL_INITIAL_WORKERS, DNS_POOL_MIN_WORKERS, DNS_POOL_MAX_WORKERS,
+                           DNS_POOL_INCREASE, DNS_POOL_DECREASE, DNS_POOL_WINDOW, DNS_POOL_FAILURE_THRESHOLD)
+
+    def new_worker_pool(self, nameservers, port=DNS_PORT, metrics=None):
         """
-        异步检测域名的连通性。
-        返回: (str: 域名, bool: 是否有效, set: IPv4地址集合)
+        在当前进程中创建DNS解析工作池（DNSWorkerPool），通过 submit()/finish() 追加域名，
+        results() 按完成顺序产出 (域名, 是否有效, IPv4地址集合, IPv6地址集合, TTL, 状态)。
+        metrics 为 {DNS服务器 -> NameserverMetrics}，不为 None 时记录各服务器的查询指标。
         """
-        async with semaphore:  # 限制并发数
-            is_valid, resolved_ipv4s = await self.__resolve(dnsresolver, domain)
-            return domain, is_valid, resolved_ipv4s
+        if self.dns_engine == "udp":
+            resolve, resolver_factory = self.__resolve_udp, self.__new_udp_resolver
+        else:
+            resolve, resolver_factory = self.__resolve, self.__new_dnspython_resolver
+        return DNSWorkerPool(nameservers, port, resolve, self.__new_limiter, resolver_factory, metrics,
+                             DNS_DOMAIN_BUDGET, DNS_HEDGE_PERCENTILE, DNS_HEDGE_MIN_DELAY, DNS_HEDGE_INITIAL_DELAY)
 
-    async def __test_domains(self, domainList, nameservers, port=53):
+    async def __test_domains(self, domain_batches, nameservers, phase, port=DNS_PORT, sharded=False, on_result=None):
         """
-        测试域名列表中的域名，获取其有效性及IP地址。
-        返回: (set: 有效域名集合, dict: {域名 -> {IPv4地址集合}}, set: 所有唯一IPv4地址集合)
+        测试域名的有效性并获取其IP地址。
+        domain_batches 为逐批产出待测域名的异步迭代器，后续批次可以在解析进行中陆续到达；
+        每批先沿用快照结论，其余交给DNS服务器解析。
+        phase 为解析阶段名（"china"/"global"）；sharded 为 True 时分片到多个子进程中解析；
+        on_result(域名, 是否有效) 在每个域名得出结论时调用，结论未知的域名视为无效。
+        结论直接写入按域名编号存储的 resolve_flags（超时或 SERVFAIL 的域名不标记为已解析），IP地址写入 ip_table；
+        由DNS服务器实际应答得出的结论同时记入 answered_flags，供复查历史判断本次是否真正复查过。
+        返回: (int: 有效域名数, int: 超时或 SERVFAIL 而结论未知的域名数)
         """
-        logger.info(f"正在使用DNS服务器 {nameservers} 解析域名...")
-        dnsresolver = DNSResolver()
-        dnsresolver.nameservers = nameservers  # 设置DNS服务器
-        dnsresolver.port = port
+        checked_flag, valid_flag = ((FLAG_CHINA_CHECKED, FLAG_CHINA_VALID) if phase == "china"
+                                    else (FLAG_GLOBAL_CHECKED, FLAG_GLOBAL_VALID))
+        domain_ids, resolve_flags, answered_flags, ip_table = (self.domain_ids, self.resolve_flags, self.answered_flags,
+                                                               self.ip_table)
+        counts = {"valid": 0, "unknown": 0, "ipv4": 0, "ipv6": 0}
+
+        journal = self.journal
+        journaled = journal.load(phase) if journal is not None else {}  # 中断前已记录的结论
+
+        def accept(domain, is_valid, resolved_ipv4s, resolved_ipv6s, checked=True, answered=False, replayed=False):
+            if journal is not None and not replayed:
+                journal.record(phase, domain, is_valid, checked, answered, resolved_ipv4s, resolved_ipv6s)
+            domain_id = domain_ids[domain]
+            if checked:
+                resolve_flags[domain_id] |= checked_flag
+                if answered:
+                    answered_flags[domain_id] |= checked_flag
+            if is_valid:
+                resolve_flags[domain_id] |= valid_flag
+                counts["valid"] += 1
+                if resolved_ipv4s or resolved_ipv6s: # 只有当解析到IP时才写入IP地址表
+                    ip_table.set(domain_id, resolved_ipv4s, resolved_ipv6s)
+                    counts["ipv4"] += len(resolved_ipv4s)
+                    counts["ipv6"] += len(resolved_ipv6s)
+            if on_result is not None:
+                on_result(domain, is_valid)
 
-        semaphore = asyncio.Semaphore(500)  # 限制并发量为 500
+        logger.info(f"正在使用DNS服务器 {nameservers} 解析域名...")
+        metrics = self.dns_metrics.setdefault(phase, {})
+        if sharded:
+            pool = ShardedWorkerPool(self.dns_processes, nameservers, port, self.dns_engine, metrics)
+        else:
+            pool = self.new_worker_pool(nameservers, port, metrics)
+        reused = {"journal": 0, "snapshot": 0, "deferred": 0}
 
-        # 添加异步任务
-        taskList = []
-        total_domains = len(domainList)
-        for domain in domainList:
-            task = asyncio.ensure_future(self.__pingx(dnsresolver, domain, semaphore))
-            taskList.append(task)
+        async def feed():
+            try:
+                async for domainList in domain_batches:
+                    # 续跑时先沿用中断前已记录的结论
+                    if journaled:
+                        remaining = []
+                        for domain in domainList:
+                            entry = journaled.pop(domain, None)
+                            if entry is None:
+                                remaining.append(domain)
+                                continue
+                            is_valid, checked, answered, resolved_ipv4s, resolved_ipv6s = entry
+                            accept(domain, is_valid, resolved_ipv4s, resolved_ipv6s, checked, answered, True)
+                        reused["journal"] += len(domainList) - len(remaining)
+                        domainList = remaining
+                    # 增量模式下，未被选中复查的域名直接沿用上次快照中的结论
+                    if self.snapshot_state is not None:
+                        known, domainList, deferred = self.__snapshot_results(phase, domainList)
+                        for domain, (is_valid, resolved_ipv4s, resolved_ipv6s) in known.items():
+                            accept(domain, is_valid, resolved_ipv4s, resolved_ipv6s)
+                        for domain in deferred:  # 超出复查预算的域名本次结论未知
+                            accept(domain, False, set(), set(), False)
+                        reused["snapshot"] += len(known)
+                        reused["deferred"] += len(deferred)
+                    pool.submit(domainList)
+            finally:
+                pool.finish()
+
+        feeder = asyncio.ensure_future(feed())
 
         # 监控任务完成进度
-        valid_domains_set = set()
-        domain_to_ipv4_map = {}
-        all_ipv4_set = set()
         completed_count = 0
 
-        for future in asyncio.as_completed(taskList):
-            domain, is_valid, resolved_ipv4s = await future
-            completed_count += 1
-
+        try:
+            async for domain, is_valid, resolved_ipv4s, resolved_ipv6s, _, status in pool.results():
+                completed_count += 1
+                if status in FAILURE_STATUSES:
+                    counts["unknown"] += 1
+                accept(domain, is_valid, resolved_ipv4s, resolved_ipv6s, status not in FAILURE_STATUSES, True)
+
+                # 每完成 5000 个任务，输出一次进度
+                if completed_count % 5000 == 0:
+                    logger.info(f"已完成 {completed_count}/{pool.submitted} 个域名解析，使用DNS服务器: {nameservers}")
+            await feeder
+        finally:
+            if not feeder.done():  # 解析出错或被取消时不再追加域名
+                feeder.cancel()
+
+        if self.snapshot_state is not None:
+            logger.info(f"增量模式沿用快照结论{reused['snapshot']}个域名，超出预算推迟{reused['deferred']}个域名，阶段: {phase}")
+        logger.info(f"解析完成，共找到{counts['valid']}个有效域名，解析到{counts['ipv4']}个IPv4地址和{counts['ipv6']}个IPv6地址，使用DNS服务器: {nameservers}。")
+        if counts["unknown"]:
+            logger.warning(f"{counts['unknown']}个域名解析超时或 SERVFAIL，结论未知，将沿用上次的输出结果。")
+        if journal is not None:
+            journal.flush()
+            if reused["journal"]:
+                logger.info(f"断点续跑沿用已记录的结论{reused['journal']}个域名，阶段: {phase}")
+        return counts["valid"], counts["unknown"]
+
+    async def __resolve_pipeline(self, china_nameservers, global_nameservers):
+        """
+        以流水线方式同时运行国内和国外DNS解析：国内DNS未能解析的域名按批立即交给国外DNS解析，
+        国内DNS解析全部完成时即生成 all-lite.txt，无需等待国外DNS。
+        返回: (国内DNS的 __test_domains 结果, 国外DNS的 __test_domains 结果)
+        """
+        stage_start = time.perf_counter()
+        pending_count = len(self.recheck_domains) if self.snapshot_state is not None else self.domain_count()
+        sharded = self.dns_processes > 1 and pending_count >= DNS_SHARD_MIN_DOMAINS
+        global_batches = asyncio.Queue()  # 交给国外DNS的域名批次，None 表示国内DNS解析已结束
+        failed = []  # 国内DNS未能解析、尚未交给国外DNS的域名
+
+        def forward(domain, is_valid):
+            nonlocal failed
             if is_valid:
-                valid_domains_set.add(domain)
-                if resolved_ipv4s: # 只有当解析到IPv4时才添加到map和set
-                    domain_to_ipv4_map[domain] = resolved_ipv4s
-                    all_ipv4_set.update(resolved_ipv4s)
-
-            # 每完成 5000 个任务，输出一次进度
-            if completed_count % 5000 == 0 or completed_count == total_domains:
-                logger.info(f"已完成 {completed_count}/{total_domains} 个域名解析({completed_count / total_domains * 100:.2f}%)，使用DNS服务器: {nameservers}")
-
-        logger.info(f"解析完成，共找到{len(valid_domains_set)}个有效域名和{len(all_ipv4_set)}个唯一IPv4地址，使用DNS服务器: {nameservers}。")
-        return valid_domains_set, domain_to_ipv4_map, all_ipv4_set
+                return
+            failed.append(domain)
+            if len(failed) >= DNS_PIPELINE_BATCH_SIZE:
+                global_batches.put_nowait(failed)
+                failed = []
+
+        async def china_batches():
+            yield [domain for domain in self.domain_names if domain]
+
+        async def queued_batches():
+            while True:
+                batch = await global_batches.get()
+                if batch is None:
+                    return
+                yield batch
+
+        global_task = asyncio.ensure_future(
+            self.__test_domains(queued_batches(), global_nameservers, "global", self.dns_port, sharded)
+        )
+        try:
+            try:
+                china_result = await self.__test_domains(china_batches(), china_nameservers, "china", self.dns_port,
+                                                         sharded, forward)
+            finally:
+                if failed:
+                    global_batches.put_nowait(failed)
+                global_batches.put_nowait(None)
+            self.__record_stage("china_dns", stage_start)
+
+            # 国内DNS结论已全部得出，先生成 all-lite.txt；写入和索引生成放在线程池中进行，不阻塞仍在进行的国外DNS解析
+            write_start = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, self.__write_lite)
+            self.__record_stage("write_lite", write_start)
+        except BaseException:
+            # 国内DNS阶段出错时取消国外DNS解析并等待其结束，使其工作池关闭解析器、结束子进程
+            global_task.cancel()
+            await asyncio.gather(global_task, return_exceptions=True)
+            raise
+
+        global_result = await global_task
+        self.__record_stage("global_dns", stage_start)
+        return china_result, global_result
+
+    def __write_lite(self):
+        """
+        生成 all-lite.txt，国内DNS结论未知的域名沿用上次 all-lite.txt 的结果。
+        在线程池中与国外DNS解析同时运行：只读取国内DNS的结论位，只写入 domain_masks 和 unknown_masks，国外DNS解析不会访问这两者。
+        """
+        self.__mark_domains(MASK_CHINA_VALID, lambda flags: flags & FLAG_CHINA_VALID)
+        self.__mark_domains(MASK_CHINA_VALID, lambda flags: not flags & FLAG_CHINA_CHECKED, self.unknown_masks)
+        self.__write_outputs([("all-lite.txt", "cloudyun-AD-rules-check-lite", MASK_CHINA_VALID, False)])
+
+    def __prepare_incremental(self):
+        """增量模式：对比上次快照，按每个域名的复查历史和本次预算确定需要重新解析的域名"""
+        # 续跑时读取开始时保存的快照副本，与中断前的调度保持一致
+        state = load_snapshot(self.journal.previous_path(self.snapshot_file) if self.journal is not None
+                              else self.snapshot_file)
+        if state is None:
+            logger.info("未找到可用的快照，本次对全部域名进行解析。")
+            return
+        domains = [domain for domain in self.domain_names if domain]
+        existing_count = sum(1 for domain in domains if domain in state)
+        removed_count = len(state) - existing_count
+
+        self.recheck_domains, stats = plan_rechecks(domains, state, self.run_time, INCREMENTAL_DOMAIN_BUDGET,
+                                                    INCREMENTAL_FLAPPING_STREAK, INCREMENTAL_BASE_INTERVAL_DAYS,
+                                                    INCREMENTAL_MAX_INTERVAL_DAYS,
+                                                    INCREMENTAL_RECHECK_TOLERANCE_HOURS * 3600)
+        self.snapshot_state = state
+        logger.info(f"增量模式: 新增{len(domains) - existing_count}个域名，移除{removed_count}个域名；"
+                    f"新增或结论不完整{stats['new']}个、结论刚变化{stats['changed']}个、结论尚未稳定{stats['young']}个、"
+                    f"到期复查{stats['due']}个，"
+                    f"预算{INCREMENTAL_DOMAIN_BUDGET or '不限'}，共需解析{stats['selected']}个域名。")
+        if stats["deferred"]:
+            logger.warning(f"{stats['deferred']}个待复查域名超出本次预算，沿用上次的输出结果，留待下次运行。")
+
+    def __snapshot_results(self, phase, domainList):
+        """
+        从快照中取出某阶段的已知结论。
+        返回: (dict: {域名 -> (是否有效, {IPv4地址集合}, {IPv6地址集合})}, set: 需要重新解析的域名集合,
+               set: 未被选中复查、快照中也没有该阶段结论的域名集合（超出预算，本次结论未知）)
+        """
+        checked_flag, valid_flag = ((FLAG_CHINA_CHECKED, FLAG_CHINA_VALID) if phase == "china"
+                                    else (FLAG_GLOBAL_CHECKED, FLAG_GLOBAL_VALID))
+        known = {}
+        misses = set()
+        deferred = set()
+        for domain in domainList:
+            if domain in self.recheck_domains:
+                misses.add(domain)
+                continue
+            entry = self.snapshot_state.get(domain)
+            if entry is None or not entry[0] & checked_flag:
+                deferred.add(domain)
+                continue
+            flags, ips = entry[0], entry[1]
+            ips = ips.split(",") if ips else []
+            known[domain] = (bool(flags & valid_flag), {ip for ip in ips if ":" not in ip}, {ip for ip in ips if ":" in ip})
+        return known, misses, deferred
+
+    def __save_snapshot(self):
+        """
+        保存本次运行的域名集合、解析结论与复查历史，供下次增量运行使用；结论未知的阶段不标记为已解析，下次优先复查。
+        本次由DNS服务器实际应答得出完整结论的域名以输出状态位（MASK_*）作为结论更新历史；
+        沿用快照或超出预算的域名沿用旧历史，不计为复查。
+        """
+        previous = self.snapshot_state or {}
+        state = {}
+        checked_count = 0
+        for domain_id, (domain, flags, answered) in enumerate(zip(self.domain_names, self.resolve_flags,
+                                                                  self.answered_flags)):
+            if not domain:
+                continue
+            checked_now = is_conclusive(answered | (flags & FLAG_CHINA_VALID))
+            checked_count += checked_now
+            history = update_history(previous.get(domain), self.domain_masks[domain_id], checked_now, self.run_time)
+            state[domain] = (flags, self.ip_table.addresses(domain_id), *history)
+        try:
+            save_snapshot(self.snapshot_file, state)
+            logger.info(f"已保存{len(state)}个域名的解析结论到快照文件 {self.snapshot_file}，"
+                        f"其中{checked_count}个域名本次由DNS服务器实际复查。")
+        except Exception as e:
+            logger.error(f"保存快照文件 {self.snapshot_file} 失败: {e}")
 
     def filter_valid_rules(self):
-        """过滤有效的规则, 并生成 all-lite.txt, all.txt, all-cn.txt"""
+        """过滤有效的规则, 并生成 all.txt, all-lite.txt, all-cn.txt"""
         # 国内和国外DNS服务器
-        china_nameservers = ["119.29.29.29", "223.6.6.6", "180.184.1.1"]  # 国内DNS
-        global_nameservers = ["1.1.1.1", "8.8.8.8", "9.9.9.9"]  # 国外DNS
+        china_nameservers = self.china_nameservers  # 国内DNS
+        global_nameservers = self.global_nameservers  # 国外DNS
 
-        # --- 1. 中国 DNS 解析 ---
-        loop = asyncio.get_event_loop()
-        china_valid_domains, china_domain_ip_map, china_ipv4s = loop.run_until_complete(
-            self.__test_domains(self.domain_set, china_nameservers)
-        )
+        # --- 0. 断点续跑：续用中断前的解析结论日志；增量模式：按复查历史和预算选出需要解析的域名 ---
+        self.version_time = self.get_beijing_time()
+        if self.journal_dir:
+            self.__open_journal()
+        if self.incremental:
+            self.__prepare_incremental()
 
-        # --- 2. 生成 all-lite.txt 文件 ---
-        lite_rules = []
-        for rule in self.valid_rules:
-            _, domain = self.__parse_line(rule)
-            # 保留不需要域名解析的规则 或 国内 DNS 解析成功的域名对应的规则
-            if domain is None or domain in china_valid_domains:
-                lite_rules.append(rule)
-
-        # 保存 all-lite.txt 文件
-        lite_output_file = "all-lite.txt"
-        self.save_rules_to_file(lite_rules, lite_output_file, "cloudyun-AD-rules-check-lite")
-        logger.info(f"已保存{len(lite_rules)}条规则到文件 {lite_output_file}。")
-
-        # --- 3. 国外 DNS 解析 (补充) ---
-        unresolved_domains = self.domain_set - china_valid_domains
-        global_valid_domains = set()
-        global_domain_ip_map = {}
-        global_ipv4s = set()
-        if unresolved_domains:
-            logger.info(f"正在尝试使用全球DNS解析{len(unresolved_domains)}个未解析域名...")
-            global_valid_domains, global_domain_ip_map, global_ipv4s = loop.run_until_complete(
-                self.__test_domains(unresolved_domains, global_nameservers)
-            )
-        else:
-             logger.info("中国DNS检查后没有未解析的域名。")
-
-        # --- 4. 合并结果 ---
-        self.valid_domains = china_valid_domains.union(global_valid_domains)
-        # Combine IP maps (global DNS results overwrite China DNS if domain exists in both)
-        self.domain_to_ip_map = china_domain_ip_map.copy()
-        self.domain_to_ip_map.update(global_domain_ip_map)
-        # Combine all unique IPv4s found
-        self.ipv4_set = china_ipv4s.union(global_ipv4s)
-
-        logger.info(f"唯一有效域名总数(中国+全球DNS): {len(self.valid_domains)}")
-        logger.info(f"发现的唯一IPv4地址总数: {len(self.ipv4_set)}")
-
-        # --- 5. 准备 all.txt 的规则 ---
-        all_txt_rules = []
-        for rule in self.valid_rules:
-            _, domain = self.__parse_line(rule)
-            # 保留不需要域名解析的规则 或 所有解析成功的域名对应的规则
-            if domain is None or domain in self.valid_domains:
-                all_txt_rules.append(rule)
-        logger.info(f"已筛选{len(all_txt_rules)}条规则用于all.txt文件。")
-
-        # --- 6. GeoIP 判断 (使用修正后的逻辑) ---
-        self.cn_domains = set() # Reset cn_domains before check
-        if self.ipv4_set: # Only proceed if we have IPs to check
+        # --- 1+2. 国内DNS解析，未解析的域名随即交给国外DNS解析 (流水线) ---
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.__resolve_pipeline(china_nameservers, global_nameservers))
+        finally:
+            if self.journal is not None:
+                self.journal.flush()  # 出错中断时也写入已缓冲的结论
+
+        # --- 3. 合并结果 (两个阶段的结论和IP地址已直接写入 resolve_flags 和 ip_table，此处只回收被覆盖的地址) ---
+        self.ip_table.compact()
+        self.__mark_domains(MASK_VALID, lambda flags: flags & (FLAG_CHINA_VALID | FLAG_GLOBAL_VALID))
+
+        ipv4_count, ipv6_count = self.ip_table.unique_counts()
+        logger.info(f"唯一有效域名总数(中国+全球DNS): {self.count_domains(MASK_VALID)}")
+        logger.info(f"发现的唯一IPv4地址总数: {ipv4_count}，唯一IPv6地址总数: {ipv6_count}")
+
+        # --- 4. GeoIP 判断 (预加载的中国IP区间索引，IPv4 和 IPv6) ---
+        stage_start = time.perf_counter()
+        if len(self.ip_table): # Only proceed if we have IPs to check
             logger.info("开始对关联域名进行GeoIP查询...")
-            try:
-                # Ensure the GeoLite2-Country.mmdb file exists
-                geoip_db_path = 'Country.mmdb'
-                if not os.path.exists(geoip_db_path):
-                     logger.error(f"未找到GeoIP数据库文件: {geoip_db_path}，无法生成all-cn.txt文件。")
-                else:
-                    reader = geoip2.database.Reader(geoip_db_path)
-                    processed_ips = 0
-                    total_ips_to_check = len(self.ipv4_set)
-
-                    # Iterate through the domain -> {ips} map
-                    for domain, ips in self.domain_to_ip_map.items():
-                        for ip in ips:
-                            processed_ips += 1
-                            try:
-                                response = reader.country(ip)
-                                if response.country.iso_code == 'CN':
-                                    self.cn_domains.add(domain)
-                                    # Log progress periodically
-                                    # if processed_ips % 1000 == 0 or processed_ips == total_ips_to_check:
-                                    #    logger.info(f"GeoIP check progress: {processed_ips}/{total_ips_to_check} IPs checked.")
-                                    break # Found a CN IP for this domain, move to the next domain
-                            except geoip2.errors.AddressNotFoundError:
-                                # logger.warning(f"IP address not found in GeoIP database: {ip}")
-                                pass # Ignore IPs not found in the database
-                            except Exception as geo_e:
-                                logger.error(f"GeoIP lookup error for IP {ip}: {geo_e}")
-                                # Optionally break inner loop or handle differently
-                        # Log progress after each domain if needed, or periodically based on IP count above
-
-                    reader.close()
-                    logger.info(f"GeoIP查询完成，共找到{len(self.cn_domains)}个与中国IP关联的域名。")
-
-            except Exception as e:
-                logger.error(f"Failed to load or use GeoIP database: {e}")
-                # Ensure cn_domains is empty if GeoIP fails catastrophically
-                self.cn_domains = set()
-
+            geoip_db_path = self.geoip_db_file
+            if not os.path.exists(geoip_db_path):
+                logger.error(f"未找到GeoIP数据库文件: {geoip_db_path}，无法生成all-cn.txt文件。")
+            else:
+                try:
+                    cn_index = CountryIPIndex.load(geoip_db_path, "CN")
+                    logger.info(f"已加载GeoIP数据库，共{len(cn_index)}个中国IP区间。")
+                    cn_domain_ids = cn_index.match_table(self.ip_table)
+                    for domain_id in cn_domain_ids:
+                        self.domain_masks[domain_id] |= MASK_CN
+                    logger.info(f"GeoIP查询完成，共找到{len(cn_domain_ids)}个与中国IP关联的域名。")
+                except Exception as e:
+                    logger.error(f"Failed to load or use GeoIP database: {e}")
         else:
-             logger.info("未找到可用于GeoIP查询的IPv4地址。")
-
-
-        # --- 7. 生成 all-cn.txt 文件 (移到循环外部) ---
-        if self.cn_domains or any(self.__parse_line(rule)[1] is None for rule in self.valid_rules): # Check if there are CN domains or rules without domains
-             cn_rules = []
-             for rule in self.valid_rules:
-                 _, domain = self.__parse_line(rule)
-                 # 保留不需要域名解析的规则 或 关联域名在 cn_domains 中的规则
-                 if domain is None or domain in self.cn_domains:
-                     cn_rules.append(rule)
-
-             # 保存 all-cn.txt 文件
-             if cn_rules: # Only save if there are rules to save
-                 cn_output_file = "all-cn.txt"
-                 self.save_rules_to_file(cn_rules, cn_output_file, "cloudyun-AD-rules-check-cn")
-                 logger.info(f"已保存{len(cn_rules)}条规则到文件 {cn_output_file}。")
-             else:
-                 logger.info("没有符合all-cn.txt文件要求的规则。")
-        else:
-            logger.info("未发现位于中国的域名且无非域名规则，跳过all-cn.txt文件生成。")
-
-
-        # --- 8. 返回 all.txt 的规则 ---
-        return all_txt_rules
-
-
-    def save_rules_to_file(self, rules, filename, title):
-        """通用方法：保存规则列表到指定文件，包含标准头"""
+             logger.info("未找到可用于GeoIP查询的IP地址。")
+        self.__record_stage("geoip", stage_start)
+
+        # --- 5. 一次遍历规则表，同时生成 all.txt 和 all-cn.txt (all-lite.txt 已在国内DNS解析结束时生成) ---
+        stage_start = time.perf_counter()
+        # 国外DNS也无结论的域名沿用上次 all.txt 和 all-cn.txt 的结果
+        self.__mark_domains(MASK_VALID | MASK_CN, lambda flags: not flags & (FLAG_CHINA_VALID | FLAG_GLOBAL_CHECKED),
+                            self.unknown_masks)
+        self.__write_outputs([
+            (self.output_file, "cloudyun-AD-rules-check", MASK_VALID, True),
+            ("all-cn.txt", "cloudyun-AD-rules-check-cn", MASK_CN, True),
+        ])
+        self.__record_stage("write", stage_start)
+
+        # --- 6. 增量模式：保存解析结论和复查历史（需要 GeoIP 结果作为域名结论的一部分） ---
+        if self.incremental:
+            self.__save_snapshot()
+
+        # 全部输出已生成，删除断点续跑日志
+        if self.journal is not None:
+            self.journal.remove()
+            self.journal = None
+
+    def __open_journal(self):
+        """打开断点续跑日志；日志与本次输入相符时沿用中断前的版本时间和运行时间"""
+        fingerprint = input_fingerprint(self.input_file, self.china_nameservers, self.global_nameservers,
+                                        self.incremental, INCREMENTAL_DOMAIN_BUDGET)
+        # 开始时保存上次的输出文件和快照，续跑时据此计算沿用结果、变更报告和复查调度
+        saved_files = ["all-lite.txt", self.output_file, "all-cn.txt", self.snapshot_file]
+        self.journal, resumed = ResolveJournal.open(self.journal_dir, fingerprint,
+                                                    {"version_time": self.version_time, "run_time": self.run_time},
+                                                    saved_files, JOURNAL_FLUSH_SIZE, JOURNAL_FLUSH_INTERVAL)
+        if resumed:
+            self.version_time = self.journal.header["version_time"]
+            self.run_time = self.journal.header["run_time"]
+            logger.info(f"发现中断的运行（版本时间 {self.version_time}），从断点续跑日志 {self.journal_dir} 继续。")
+
+    def __mark_domains(self, flag, predicate, domain_masks=None):
+        """为解析结论（resolve_flags）满足 predicate 的域名，在状态位图（默认为 domain_masks）中置位"""
+        if domain_masks is None:
+            domain_masks = self.domain_masks
+        for domain_id, (domain, flags) in enumerate(zip(self.domain_names, self.resolve_flags)):
+            if domain and predicate(flags):
+                domain_masks[domain_id] |= flag
+
+    def __write_header(self, f, title, total):
+        """写入规则文件的标准头"""
+        # 写入自定义前缀信息
+        f.write(f"! Title: {title}\n")
+        f.write(f"! Version: {self.version_time or self.get_beijing_time()}\n")  # 使用本次运行开始时的北京时间作为版本号
+        f.write(f"! Homepage: https://github.com/cloudyun233/cloudyun-AD-rules\n")
+        f.write(f"! Total lines: {total}\n")
+
+        # 写入其他注释行（排除已写入的标准注释）
+        standard_prefixes = ("! Title:", "! Version:", "! Homepage:", "! Total lines:")
+        for comment in self.header_comments:
+            # Ensure comment is a string and check prefix
+            if isinstance(comment, str) and not comment.startswith(standard_prefixes):
+                 f.write(comment + "\n")
+
+    def __write_outputs(self, outputs):
+        """
+        按域名状态位图一次遍历规则表，同时写出多个规则文件。
+        outputs 为 [(文件名, 标题, 所需标志位, 无规则时是否跳过)]；不需要域名解析的规则写入所有文件。
+        域名在某个文件上结论未知（unknown_masks）时，该规则是否写入沿用上次生成的文件。
+        """
+        domain_masks = self.domain_masks
+        unknown_masks = self.unknown_masks
+        # 上次生成的规则集合；有断点续跑日志时读取开始时保存的副本，续跑前写出的文件不影响结果
+        previous_rules = {filename: self.__read_rules(self.journal.previous_path(filename) if self.journal is not None
+                                                      else filename)
+                          for filename, _, _, _ in outputs}
+        rule_masks = bytearray(MASK_ALL if domain_id < 0 else domain_masks[domain_id] for domain_id in self.rule_domain_ids)
+        kept_count = 0
+        for index, (rule, domain_id) in enumerate(zip(self.valid_rules, self.rule_domain_ids)):
+            if domain_id < 0 or not unknown_masks[domain_id]:
+                continue
+            for filename, _, flag, _ in outputs:
+                if unknown_masks[domain_id] & flag and not rule_masks[index] & flag and rule in previous_rules[filename]:
+                    rule_masks[index] |= flag
+                    kept_count += 1
+        if kept_count:
+            logger.info(f"解析结论未知的规则中，有{kept_count}处沿用了上次生成的结果。")
+        # 子域名规则只在覆盖它的某条上级规则也写入的文件中剪除（上级规则本身被剪除时，更上级的规则已写入该文件）
+        written_masks = bytes(rule_masks)
+        covered_counts = [0] * len(outputs)
+        for index, parents in self.covered_rules.items():
+            parent_mask = 0
+            for parent_index in parents:
+                parent_mask |= written_masks[parent_index]
+            if rule_masks[index] & parent_mask:
+                for position, (_, _, flag, _) in enumerate(outputs):
+                    if rule_masks[index] & parent_mask & flag:
+                        covered_counts[position] += 1
+                rule_masks[index] &= ~parent_mask & 0xFF
+        counts = [sum(1 for mask in rule_masks if mask & flag) for _, _, flag, _ in outputs]
+
+        files = []
+        written = []  # 本次实际生成的文件
+        try:
+            for (filename, title, flag, skip_if_empty), count in zip(outputs, counts):
+                if skip_if_empty and count == 0:
+                    logger.warning(f"没有符合文件 {filename} 要求的规则，跳过生成。")
+                    continue
+                written.append(filename)
+                f = open(filename, "w", encoding="utf-8", buffering=1 << 20)
+                files.append((f, flag))
+                self.__write_header(f, title, count)
+
+            # 写入规则
+            for rule, mask in zip(self.valid_rules, rule_masks):
+                line = rule + "\n"
+                for f, flag in files:
+                    if mask & flag:
+                        f.write(line)
+        except Exception as e:
+            logger.error(f"保存规则文件失败: {e}")
+        finally:
+            for f, _ in files:
+                f.close()
+
+        for (filename, _, _, _), count, covered_count in zip(outputs, counts, covered_counts):
+            logger.info(f"已保存{count}条规则到文件 {filename}，剪除{covered_count}条被上级域名规则覆盖的子域名规则。")
+
+        # 为每个输出文件生成二进制查询索引
+        if RULE_INDEX_SUFFIX:
+            for (filename, _, flag, _) in outputs:
+                if filename not in written:
+                    continue
+                index_file = os.path.splitext(filename)[0] + RULE_INDEX_SUFFIX
+                try:
+                    domain_count, regex_count = build_index(
+                        (rule for rule, mask in zip(self.valid_rules, rule_masks) if mask & flag), index_file)
+                    logger.info(f"已生成索引文件 {index_file}: 域名{domain_count}个，正则{regex_count}条。")
+                except Exception as e:
+                    logger.error(f"生成索引文件 {index_file} 失败: {e}")
+
+        # 生成各输出文件相对上次的变更报告（与之前写出的文件合并）
+        report = {"generated": self.version_time or self.get_beijing_time(), "files": self.delta_files}
+        for (filename, _, flag, _) in outputs:
+            if filename not in written:
+                continue
+            current = {rule for rule, mask in zip(self.valid_rules, rule_masks) if mask & flag}
+            added = sorted(current - previous_rules[filename])
+            removed = sorted(previous_rules[filename] - current)
+            report["files"][os.path.basename(filename)] = {
+                "added_count": len(added), "removed_count": len(removed), "added": added, "removed": removed,
+            }
+            logger.info(f"文件 {filename} 新增{len(added)}条规则，删除{len(removed)}条规则。")
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                # 写入自定义前缀信息
-                f.write(f"! Title: {title}\n")
-                f.write(f"! Version: {self.get_beijing_time()}\n")  # 使用当前北京时间作为版本号
-                f.write(f"! Homepage: https://github.com/cloudyun233/cloudyun-AD-rules\n")
-                f.write(f"! Total lines: {len(rules)}\n")
-
-                # 写入其他注释行（排除已写入的标准注释）
-                standard_prefixes = ("! Title:", "! Version:", "! Homepage:", "! Total lines:")
-                for comment in self.header_comments:
-                    # Ensure comment is a string and check prefix
-                    if isinstance(comment, str) and not comment.startswith(standard_prefixes):
-                         f.write(comment + "\n")
-
-                # 写入规则
-                for line in rules:
-                    f.write(line + "\n")
+            with open(DELTA_REPORT_FILE, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
         except Exception as e:
-             logger.error(f"保存规则到文件 {filename} 失败: {e}")
+            logger.error(f"保存变更报告 {DELTA_REPORT_FILE} 失败: {e}")
 
+    @staticmethod
+    def __read_rules(filename):
+        """读取已有规则文件中的规则（不含注释），文件不存在时返回空集合"""
+        if not os.path.exists(filename):
+            return set()
+        with open(filename, "r", encoding="utf-8") as f:
+            return {line.rstrip("\n") for line in f if not line.startswith("!")}
 
     def get_beijing_time(self):
         """获取当前北京时间"""
@@ -319,18 +818,151 @@ class RuleParser:
             return datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')
 
 
+    def save_metrics(self, path=METRICS_FILE):
+        """导出各阶段耗时和各DNS服务器的查询指标（查询数、每秒查询数、延迟分位数、各类错误数）"""
+        report = build_report(self.get_beijing_time(), self.stage_times, self.dns_metrics,
+                              {"china": "china_dns", "global": "global_dns"}, self.stage_peak_rss)
+        save_report(path, report)
+
     def print_statistics(self):
         """打印统计信息"""
         print("\n--- 统计信息 ---")
         print(f"读取的总规则数(不包括注释): {self.total_rules}")
+        print(f"被上级域名覆盖的子域名规则数: {self.pruned_rules}")
+        print(f"被正则规则覆盖而剪除的规则数: {self.regex_pruned_rules} (减少待解析域名{self.regex_saved_domains}个)")
         print(f"有效语法规则数: {len(self.valid_rules)}")
-        print(f"提取的唯一域名数: {len(self.domain_set)}")
-        print(f"解析成功的域名数(A或AAAA记录): {len(self.valid_domains)}")
-        print(f"发现的唯一IPv4地址数: {len(self.ipv4_set)}")
-        print(f"与中国IP关联的域名数: {len(self.cn_domains)}")
+        ipv4_count, ipv6_count = self.ip_table.unique_counts()
+        self_mb, children_mb = peak_rss_mb()
+        print(f"提取的唯一域名数: {self.domain_count()}")
+        print(f"解析成功的域名数(A或AAAA记录): {self.count_domains(MASK_VALID)}")
+        print(f"发现的唯一IPv4地址数: {ipv4_count}")
+        print(f"发现的唯一IPv6地址数: {ipv6_count}")
+        print(f"与中国IP关联的域名数: {self.count_domains(MASK_CN)}")
+        print(f"峰值内存: {self_mb}MB (解析子进程: {children_mb}MB)")
         print("--- 统计结束 ---")
 
 
+class ShardedWorkerPool:
+    """
+    与 DNSWorkerPool 接口相同（submit/finish/results）的多进程解析池：
+    按域名哈希把追加的域名分给各子进程，每个子进程运行独立的事件循环和工作池，批量回传结果。
+    """
+
+    def __init__(self, processes, nameservers, port, dns_engine, metrics=None):
+        context = multiprocessing.get_context("spawn")
+        self.metrics = metrics
+        self.result_queue = context.Queue()
+        self.input_queues = [context.Queue() for _ in range(processes)]
+        self.processes = [
+            context.Process(target=_resolve_shard,
+                            args=(input_queue, nameservers, port, dns_engine, self.result_queue), daemon=True)
+            for input_queue in self.input_queues
+        ]
+        for process in self.processes:
+            process.start()
+        self.submitted = 0
+        logger.info(f"已启动{len(self.processes)}个解析进程，使用DNS服务器: {nameservers}")
+
+    def submit(self, domainList):
+        """按域名哈希分片，把域名交给对应的子进程"""
+        shards = [[] for _ in self.input_queues]
+        for domain in domainList:
+            shards[zlib.crc32(domain.encode("utf-8")) % len(shards)].append(domain)
+        for input_queue, shard in zip(self.input_queues, shards):
+            if shard:
+                input_queue.put(shard)
+                self.submitted += len(shard)
+
+    def finish(self):
+        """通知所有子进程不再追加域名"""
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+
+    async def results(self):
+        """
+        按子进程回传的顺序逐个产出结果，并合并子进程的DNS服务器指标。
+        子进程出错或异常退出、或回传的结果少于追加的域名数时抛出 RuntimeError，避免部分域名静默沿用旧结果。
+        """
+        loop = asyncio.get_running_loop()
+        running = len(self.processes)
+        produced = 0
+        try:
+            while running:
+                try:
+                    batch = await loop.run_in_executor(None, self.result_queue.get, True, 5)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in self.processes):
+                        raise RuntimeError("解析子进程异常退出")
+                    continue
+                if batch is None:  # 子进程完成
+                    running -= 1
+                    continue
+                if isinstance(batch, str):  # 子进程解析出错
+                    raise RuntimeError(f"解析子进程出错: {batch}")
+                if isinstance(batch, dict):  # 子进程的DNS服务器指标
+                    if self.metrics is not None:
+                        merge_nameserver_metrics(self.metrics, {ns: NameserverMetrics.from_state(state)
+                                                                for ns, state in batch.items()})
+                    continue
+                for result in batch:
+                    produced += 1
+                    yield result
+            for process in self.processes:
+                await loop.run_in_executor(None, process.join)
+            if any(p.exitcode != 0 for p in self.processes):
+                raise RuntimeError("解析子进程异常退出")
+            if produced < self.submitted:
+                raise RuntimeError(f"解析子进程只回传了{produced}/{self.submitted}个域名的结果")
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+
+def _resolve_shard(input_queue, nameservers, port, dns_engine, result_queue):
+    """
+    子进程入口：解析从 input_queue 陆续收到的域名（收到 None 表示结束），
+    每 DNS_SHARD_BATCH_SIZE 个结果回传一次，最后回传DNS服务器指标和 None；出错时先回传错误信息字符串再回传 None
+    """
+    async def run():
+        parser = RuleParser(None, None, dns_engine=dns_engine, dns_processes=1)
+        metrics = {}
+        pool = parser.new_worker_pool(nameservers, port, metrics)
+        loop = asyncio.get_running_loop()
+
+        async def feed():
+            try:
+                while True:
+                    domains = await loop.run_in_executor(None, input_queue.get)
+                    if domains is None:
+                        return
+                    pool.submit(domains)
+            finally:
+                pool.finish()
+
+        feeder = asyncio.ensure_future(feed())
+        batch = []
+        async for result in pool.results():
+            batch.append(result)
+            if len(batch) >= DNS_SHARD_BATCH_SIZE:
+                result_queue.put(batch)
+                batch = []
+        await feeder
+        if batch:
+            result_queue.put(batch)
+        result_queue.put({ns: m.to_state() for ns, m in metrics.items()})
+
+    try:
+        asyncio.run(run())
+    except BaseException as e:
+        logger.exception("解析子进程出错")
+        result_queue.put(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        result_queue.put(None)
+
+
 if __name__ == "__main__":
     input_file = "beforeall.txt"  # 输入文件
     output_file = "all.txt"      # 主输出文件 (for all rules)
@@ -345,21 +977,16 @@ if __name__ == "__main__":
         exit(1)
 
     # 解析规则并过滤
-    parser = RuleParser(input_file, output_file)
+    parser = RuleParser(input_file, output_file, incremental=INCREMENTAL_MODE, journal_dir=JOURNAL_DIR)
     parser.parse_rules()
 
-    # filter_valid_rules now handles generation of lite and cn files as side effects
-    # and returns the rules for all.txt
-    final_all_rules = parser.filter_valid_rules()
+    # filter_valid_rules 解析域名并一次性生成 all.txt, all-lite.txt 和 all-cn.txt
+    parser.filter_valid_rules()
+
+    # 导出运行指标
+    parser.save_metrics(METRICS_FILE)
 
     # 打印统计信息
     parser.print_statistics()
 
-    # 保存 all.txt 文件
-    if final_all_rules:
-        parser.save_rules_to_file(final_all_rules, output_file, "cloudyun-AD-rules-check") # Use the main output file name
-        logger.info(f"已保存{len(final_all_rules)}条规则到主输出文件 {output_file}。")
-    else:
-        logger.warning(f"没有符合主输出文件 {output_file} 要求的规则。")
-
     logger.info("脚本运行完成。")
\ No newline at end of file
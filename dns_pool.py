@@ -0,0 +1,259 @@
+# dns_pool.py
+# 队列驱动的DNS解析工作池：每个DNS服务器拥有独立的 AIMD 自适应并发窗口
+
+import asyncio
+import time
+from collections import deque
+from loguru import logger
+from metrics import LatencyHistogram, NameserverMetrics
+
+FAILURE_STATUSES = ("timeout", "servfail")  # 表示上游过载或丢包的查询结果
+# 未应答即被取消的查询（对冲查询先返回成功结果或时间预算用尽），超过该服务器的对冲延迟时计为一次失败
+ABANDONED = "abandoned"
+HEDGE_REFRESH_SAMPLES = 100  # 每积累多少个成功应答重新计算一次对冲延迟
+_FINISHED = object()  # 结果队列中表示不再追加域名的标记
+
+
+class AIMDLimiter:
+    """
+    单个DNS服务器的并发窗口（加性增、乘性减）。
+    每统计 window 次查询，若超时、SERVFAIL 和被放弃的慢查询的比例超过阈值则按倍数缩减，否则线性增长。
+    """
+
+    def __init__(self, initial, minimum, maximum, increase, decrease, window, failure_threshold):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.samples = 0
+        self.failures = 0
+
+    def record(self, status):
+        """记录一次查询结果，必要时调整并发窗口"""
+        self.samples += 1
+        if status in FAILURE_STATUSES or status == ABANDONED:
+            self.failures += 1
+        if self.samples < self.window:
+            return
+        if self.failures / self.samples > self.failure_threshold:
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.maximum, self.limit + self.increase)
+        self.samples = 0
+        self.failures = 0
+
+
+class NameserverSlot:
+    """单个DNS服务器的解析器、并发窗口、当前工作协程数、借用的并发数和成功应答的延迟分布"""
+
+    def __init__(self, nameserver, resolver, limiter, hedge_delay):
+        self.nameserver = nameserver
+        self.resolver = resolver
+        self.limiter = limiter
+        self.workers = 0
+        self.borrowed = 0  # 其他服务器的工作协程发往该服务器、仍在进行中的对冲查询数
+        self.retries = deque()  # 其他服务器失败后转交该服务器重试的域名，优先于共享队列处理
+        self.latency = LatencyHistogram()
+        self.samples = 0
+        self.hedge_delay = hedge_delay  # 超过该时间未应答时发出对冲查询
+
+    def in_use(self):
+        """占用的并发数: 自身的工作协程数加上借用的对冲查询数"""
+        return self.workers + self.borrowed
+
+    def has_capacity(self):
+        return self.in_use() < self.limiter.limit
+
+    def record_latency(self, seconds, percentile, minimum):
+        """记录一次成功应答的延迟，定期按分位数更新对冲延迟"""
+        self.latency.record(seconds)
+        self.samples += 1
+        if self.samples % HEDGE_REFRESH_SAMPLES == 0:
+            self.hedge_delay = max(minimum, self.latency.percentile(percentile))
+
+
+class DNSWorkerPool:
+    """
+    从共享队列中取出域名进行解析的工作池。
+    域名可以在迭代 results() 期间通过 submit() 陆续追加，finish() 后待全部解析完成时结束迭代。
+    各DNS服务器的工作协程数随其 AIMD 窗口增减，快的上游自然分担更多查询；
+    某个服务器超时或 SERVFAIL 时，把该域名转交下一个服务器的重试队列，由其自身的工作协程在其窗口内重试；
+    某个服务器迟迟不应答时，若另一个服务器的窗口尚有空余，在对冲延迟后向其发出相同查询（计入其窗口），取先到的成功结果。
+    """
+
+    def __init__(self, nameservers, port, resolve, limiter_factory, resolver_factory, metrics=None,
+                 budget=None, hedge_percentile=0.95, hedge_min_delay=0.05, hedge_initial_delay=0.5):
+        """
+        resolve 为协程函数 resolve(resolver, domain)，返回最后一项为查询状态的元组；
+        limiter_factory 为每个DNS服务器创建一个 AIMDLimiter；
+        resolver_factory(nameserver, port) 为每个DNS服务器创建只指向该服务器的解析器；
+        metrics 为 {DNS服务器 -> NameserverMetrics}，不为 None 时记录每个服务器的查询状态和延迟；
+        budget 为单个域名的解析时间预算（秒），超过后记为超时，为 None 时不限制；
+        对冲延迟取各服务器成功应答延迟的 hedge_percentile 分位数，不低于 hedge_min_delay，样本不足时为 hedge_initial_delay。
+        """
+        self.slots = [NameserverSlot(ns, resolver_factory(ns, port), limiter_factory(), hedge_initial_delay)
+                      for ns in nameservers]
+        self.metrics = metrics
+        self.budget = budget
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        if metrics is not None:
+            for ns in nameservers:
+                metrics.setdefault(ns, NameserverMetrics())
+        self.resolve = resolve
+        self.domains = asyncio.Queue()
+        self.completed = asyncio.Queue()
+        self.tasks = set()
+        self.submitted = 0  # 已追加的域名数
+
+    def submit(self, domainList):
+        """追加待解析的域名，需在事件循环中调用"""
+        for domain in domainList:
+            self.domains.put_nowait(domain)
+            self.submitted += 1
+        for slot in self.slots:
+            self.__spawn(slot)
+
+    def finish(self):
+        """表示不再追加域名"""
+        self.completed.put_nowait(_FINISHED)
+
+    async def results(self):
+        """按完成顺序逐个产出 (域名, *resolve 返回值)，finish() 之后全部产出完毕时结束"""
+        finished = False
+        produced = 0
+        try:
+            while not finished or produced < self.submitted:
+                result = await self.completed.get()
+                if result is _FINISHED:
+                    finished = True
+                    continue
+                produced += 1
+                yield result
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            for slot in self.slots:
+                if hasattr(slot.resolver, "close"):
+                    slot.resolver.close()
+            logger.info("DNS服务器并发窗口: " + ", ".join(f"{slot.nameserver}={slot.limiter.limit}" for slot in self.slots))
+
+    def __spawn(self, slot):
+        """补足某个DNS服务器的工作协程数到其窗口中的空余并发数"""
+        while slot.has_capacity() and (slot.retries or not self.domains.empty()):
+            slot.workers += 1
+            task = asyncio.ensure_future(self.__worker(slot))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def __next_item(self, slot):
+        """取出下一个待解析的域名，优先处理转交来的重试；没有时返回 None"""
+        if slot.retries:
+            return slot.retries.popleft()
+        try:
+            domain = self.domains.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+        index = self.slots.index(slot)
+        candidates = self.slots[index:] + self.slots[:index]
+        deadline = None if self.budget is None else time.perf_counter() + self.budget
+        return domain, candidates, deadline, None
+
+    async def __worker(self, slot):
+        try:
+            while slot.in_use() <= slot.limiter.limit:
+                item = self.__next_item(slot)
+                if item is None:
+                    break
+                result = await self.__resolve_with_fallback(*item)
+                if result is not None:
+                    await self.completed.put((item[0], *result))
+                self.__spawn(slot)
+        finally:
+            slot.workers -= 1
+
+    async def __resolve_with_fallback(self, domain, candidates, deadline, result):
+        """
+        用 candidates[0]（当前服务器）解析；超过其对冲延迟仍未应答、且下一个服务器的窗口尚有空余时，
+        向下一个服务器发出相同查询，取最先返回的成功结果。进行中的查询都超时或 SERVFAIL 时，
+        把域名连同剩余的服务器转交下一个服务器的重试队列，返回 None，结果由接手的工作协程产出。
+        超过时间预算仍没有成功结果时返回最后一次失败的结果，完全没有结果时记为超时。
+        """
+        pending = set()  # 进行中的查询任务
+        launched = 1
+        try:
+            if deadline is None or deadline > time.perf_counter():
+                pending.add(asyncio.ensure_future(self.__timed_resolve(candidates[0], domain)))
+            while pending:
+                timeout = None if deadline is None else deadline - time.perf_counter()
+                if timeout is not None and timeout <= 0:
+                    break  # 时间预算用尽
+                can_hedge = launched < len(candidates)
+                if can_hedge:
+                    hedge_delay = candidates[launched - 1].hedge_delay
+                    timeout = hedge_delay if timeout is None else min(timeout, hedge_delay)
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 对冲：最近一个服务器迟迟不应答，下一个服务器的窗口有空余时向其发出相同查询，否则继续等待
+                    if can_hedge and candidates[launched].has_capacity():
+                        pending.add(self.__borrow(candidates[launched], domain))
+                        launched += 1
+                    continue
+                for task in done:
+                    result = task.result()
+                    if result[-1] not in FAILURE_STATUSES:
+                        return result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:  # 等待被取消的查询结束，之后再取下一个域名，保证进行中的查询数不超过窗口
+                await asyncio.wait(pending)
+        remaining = candidates[launched:]
+        if remaining and (deadline is None or deadline > time.perf_counter()):
+            # 所有进行中的查询均已失败，交给下一个服务器在其自身的窗口内重试
+            target = remaining[0]
+            target.retries.append((domain, remaining, deadline, result))
+            self.__spawn(target)
+            return None
+        if result is None:
+            return False, set(), set(), None, "timeout"
+        return result
+
+    def __borrow(self, slot, domain):
+        """向其他服务器发出对冲查询，查询结束前占用该服务器窗口中的一个并发数"""
+        slot.borrowed += 1
+        task = asyncio.ensure_future(self.__timed_resolve(slot, domain))
+
+        def release(_):
+            slot.borrowed -= 1
+            self.__spawn(slot)
+
+        task.add_done_callback(release)
+        return task
+
+    async def __timed_resolve(self, slot, domain):
+        """
+        用某个DNS服务器解析一次，更新其并发窗口、对冲延迟和指标。
+        查询被取消时记为 abandoned；已超过该服务器对冲延迟仍未应答的，同时计入其并发窗口的失败数，
+        使不应答的服务器在对冲查询胜出时也能缩减窗口并出现在指标中。
+        """
+        start = time.perf_counter()
+        try:
+            result = await self.resolve(slot.resolver, domain)
+        except asyncio.CancelledError:
+            elapsed = time.perf_counter() - start
+            if elapsed >= slot.hedge_delay:
+                slot.limiter.record(ABANDONED)
+            if self.metrics is not None:
+                self.metrics[slot.nameserver].record(ABANDONED, elapsed)
+            raise
+        elapsed = time.perf_counter() - start
+        slot.limiter.record(result[-1])
+        if result[-1] not in FAILURE_STATUSES:
+            slot.record_latency(elapsed, self.hedge_percentile, self.hedge_min_delay)
+        if self.metrics is not None:
+            self.metrics[slot.nameserver].record(result[-1], elapsed)
+        return result
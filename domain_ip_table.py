@@ -0,0 +1,91 @@
+# domain_ip_table.py
+# 域名编号 -> IP地址的紧凑邻接表：IPv4 以 32 位无符号整数、IPv6 以 16 字节定长存放，避免为每个域名保存IP字符串集合
+
+import socket
+from array import array
+
+
+class DomainIPTable:
+    """
+    按域名编号存放解析到的IP地址（CSR 风格）。
+    所有域名的 IPv4 地址依次存放在一个 array("I") 中，IPv6 地址依次存放在一个 bytearray 中，
+    每个域名只记录其地址的起始位置和数量。同一域名再次写入时直接指向新写入的地址（后写入的结果覆盖先写入的），
+    被覆盖的旧地址在 compact() 时回收。
+    """
+
+    def __init__(self, domain_count):
+        self.v4 = array("I")  # 所有域名的IPv4地址
+        self.v6 = bytearray()  # 所有域名的IPv6地址，每个 16 字节
+        self.v4_start = array("I", bytes(4 * domain_count))  # 按域名编号: 在 v4 中的起始位置
+        self.v4_count = array("H", bytes(2 * domain_count))  # 按域名编号: IPv4 地址数量
+        self.v6_start = array("I", bytes(4 * domain_count))  # 按域名编号: 在 v6 中的起始位置（以地址个数计）
+        self.v6_count = array("H", bytes(2 * domain_count))  # 按域名编号: IPv6 地址数量
+
+    def set(self, domain_id, ipv4s, ipv6s):
+        """写入域名的IP地址（字符串），无法解析的地址被忽略"""
+        packed_v4 = []
+        for ip in ipv4s:
+            try:
+                packed_v4.append(int.from_bytes(socket.inet_aton(ip), "big"))
+            except OSError:
+                continue
+        packed_v6 = []
+        for ip in ipv6s:
+            try:
+                packed_v6.append(socket.inet_pton(socket.AF_INET6, ip))
+            except (OSError, ValueError):
+                continue
+        self.v4_start[domain_id] = len(self.v4)
+        self.v4_count[domain_id] = len(packed_v4)
+        self.v4.extend(packed_v4)
+        self.v6_start[domain_id] = len(self.v6) // 16
+        self.v6_count[domain_id] = len(packed_v6)
+        self.v6.extend(b"".join(packed_v6))
+
+    def ipv4_values(self, domain_id):
+        """返回域名的IPv4地址（32 位整数）"""
+        start = self.v4_start[domain_id]
+        return self.v4[start:start + self.v4_count[domain_id]]
+
+    def ipv6_values(self, domain_id):
+        """返回域名的IPv6地址（16 字节）列表"""
+        start = self.v6_start[domain_id] * 16
+        return [bytes(self.v6[offset:offset + 16])
+                for offset in range(start, start + self.v6_count[domain_id] * 16, 16)]
+
+    def addresses(self, domain_id):
+        """返回域名的IP地址字符串列表"""
+        ips = [socket.inet_ntoa(value.to_bytes(4, "big")) for value in self.ipv4_values(domain_id)]
+        ips.extend(socket.inet_ntop(socket.AF_INET6, packed) for packed in self.ipv6_values(domain_id))
+        return ips
+
+    def domain_ids(self):
+        """依次产出有IP地址的域名编号"""
+        v4_count, v6_count = self.v4_count, self.v6_count
+        for domain_id in range(len(v4_count)):
+            if v4_count[domain_id] or v6_count[domain_id]:
+                yield domain_id
+
+    def __len__(self):
+        """有IP地址的域名数量"""
+        return sum(1 for _ in self.domain_ids())
+
+    def unique_counts(self):
+        """返回 (唯一IPv4地址数, 唯一IPv6地址数)，只统计未被覆盖的地址"""
+        ipv4s, ipv6s = set(), set()
+        for domain_id in self.domain_ids():
+            ipv4s.update(self.ipv4_values(domain_id))
+            ipv6s.update(self.ipv6_values(domain_id))
+        return len(ipv4s), len(ipv6s)
+
+    def compact(self):
+        """按域名编号顺序重排地址并回收被覆盖的旧地址"""
+        v4, v6 = array("I"), bytearray()
+        for domain_id in range(len(self.v4_count)):
+            start, count = self.v4_start[domain_id], self.v4_count[domain_id]
+            self.v4_start[domain_id] = len(v4)
+            v4.extend(self.v4[start:start + count])
+            start, count = self.v6_start[domain_id], self.v6_count[domain_id]
+            self.v6_start[domain_id] = len(v6) // 16
+            v6.extend(self.v6[start * 16:(start + count) * 16])
+        self.v4, self.v6 = v4, v6
@@ -0,0 +1,46 @@
+# domain_trie.py
+# 以反转标签（com -> example -> www）为键的域名前缀树，用于判断域名是否被上级域名规则覆盖
+
+_END = None  # 节点终止标记，域名标签不会为 None
+
+
+class DomainTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain):
+        """插入一个域名"""
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node[_END] = True
+
+    def covers(self, domain, include_self=False):
+        """
+        判断树中是否存在 domain 的上级域名。
+        include_self 为 True 时，domain 本身在树中也算覆盖。
+        """
+        labels = domain.split(".")
+        node = self.root
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                return False
+            if _END in node and (depth < len(labels) or include_self):
+                return True
+        return False
+
+    def ancestors(self, domain):
+        """返回树中 domain 的所有上级域名（不含 domain 本身），从顶级到近级排列"""
+        labels = domain.split(".")
+        node = self.root
+        found = []
+        for depth, label in enumerate(reversed(labels), 1):
+            if depth == len(labels):
+                break
+            node = node.get(label)
+            if node is None:
+                break
+            if _END in node:
+                found.append(".".join(labels[-depth:]))
+        return found
@@ -0,0 +1,108 @@
+# fake_dns.py
+# 本地DNS桩服务器，用于在不访问公共DNS的情况下测试和基准测试解析流程
+
+import asyncio
+import random
+import struct
+import zlib
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+
+
+class FakeDNSServer(asyncio.DatagramProtocol):
+    """
+    对任意域名作答的桩服务器：按域名的 CRC32 决定返回 NXDOMAIN 还是 A/AAAA 记录，
+    因此同一域名每次得到的结果一致，便于比较不同解析引擎。
+    A 记录取自完整的 32 位摘要，散布在整个 IPv4 空间，其中一部分会落入国内网段，可用于测试 GeoIP 阶段。
+    响应延迟服从 latency_dist 指定的分布（fixed 固定、uniform 在 [0, 2*latency] 内均匀、exponential 指数分布），
+    并按 drop_rate 随机丢弃查询以模拟丢包；随机数由 seed 决定，保证基准测试可复现。
+    """
+
+    def __init__(self, latency=0.0, nxdomain_ratio=0.3, ttl=300, latency_dist="fixed", drop_rate=0.0, seed=0):
+        if latency_dist not in ("fixed", "uniform", "exponential"):
+            raise ValueError(f"未知的延迟分布: {latency_dist}")
+        self.latency = latency
+        self.nxdomain_ratio = nxdomain_ratio
+        self.ttl = ttl
+        self.latency_dist = latency_dist
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.transport = None
+        self.queries = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        response = self.answer(data)
+        if response is None:
+            return
+        delay = self.next_delay()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+    def next_delay(self):
+        """按配置的分布抽取一次响应延迟（秒）"""
+        if self.latency <= 0 or self.latency_dist == "fixed":
+            return self.latency
+        if self.latency_dist == "uniform":
+            return self.random.uniform(0, 2 * self.latency)
+        return self.random.expovariate(1 / self.latency)
+
+    def answer(self, data):
+        """构造响应报文，无法解析的查询返回 None"""
+        if len(data) < 17:
+            return None
+        qid, flags = struct.unpack_from("!HH", data, 0)
+        offset = 12
+        labels = []
+        while offset < len(data) and data[offset] != 0:
+            length = data[offset]
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        offset += 1
+        if offset + 4 > len(data):
+            return None
+        qtype = struct.unpack_from("!H", data, offset)[0]
+        question = data[12:offset + 4]
+        name = b".".join(labels).lower()
+        digest = zlib.crc32(name)
+
+        header_flags = 0x8180 | (flags & 0x0100)  # QR + RA，回显 RD
+        if digest % 1000 < self.nxdomain_ratio * 1000:
+            return struct.pack("!HHHHHH", qid, header_flags | 3, 1, 0, 0, 0) + question
+        if qtype == QTYPE_A:
+            rdata = struct.pack("!I", zlib.crc32(name, 0x5A5A5A5A))  # 由域名决定的确定地址
+        elif qtype == QTYPE_AAAA:
+            rdata = b"\xfd\x00" + b"\x00" * 10 + struct.pack("!I", digest)
+        else:
+            return struct.pack("!HHHHHH", qid, header_flags, 1, 0, 0, 0) + question
+        record = b"\xc0\x0c" + struct.pack("!HHIH", qtype, 1, self.ttl, len(rdata)) + rdata
+        return struct.pack("!HHHHHH", qid, header_flags, 1, 1, 0, 0) + question + record
+
+
+async def start_fake_dns(host="127.0.0.1", port=0, **options):
+    """启动桩服务器，返回 (transport, 服务器实例, 实际监听端口)"""
+    loop = asyncio.get_running_loop()
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: FakeDNSServer(**options), local_addr=(host, port)
+    )
+    return transport, server, transport.get_extra_info("sockname")[1]
+
+
+def serve_forever(port_queue, host="127.0.0.1", **options):
+    """在独立进程中运行桩服务器，启动后把监听端口放入 port_queue"""
+    async def main():
+        _, _, port = await start_fake_dns(host, **options)
+        port_queue.put(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
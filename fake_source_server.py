@@ -0,0 +1,126 @@
+# fake_source_server.py
+# 本地上游规则桩服务器，用于在不访问真实上游的情况下检查 merge_rules.py 的条件下载和未变化时提前退出
+
+import hashlib
+import os
+import tempfile
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeSourceServer(ThreadingHTTPServer):
+    """
+    以内存中的正文作为上游规则文件的 HTTP 服务器，支持 ETag/If-None-Match 和 Last-Modified/If-Modified-Since。
+    通过 set_source() 修改正文以模拟上游更新；statuses 按顺序记录每次请求的 (路径, 状态码)。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeSourceHandler)
+        self.sources = {}  # 路径 -> (正文, ETag, Last-Modified)
+        self.statuses = []
+        self.lock = threading.Lock()
+
+    def set_source(self, path, body):
+        """设置某个路径的正文，正文变化时 ETag 和 Last-Modified 随之变化"""
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        with self.lock:
+            previous = self.sources.get(path)
+            if previous is not None and previous[1] == etag:
+                return
+            self.sources[path] = (body, etag, formatdate(usegmt=True))
+
+    def url(self, path):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+
+class FakeSourceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            source = server.sources.get(self.path)
+        if source is None:
+            status = 404
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            body, etag, last_modified = source
+            if self.headers.get("If-None-Match") == etag or (
+                    "If-None-Match" not in self.headers and self.headers.get("If-Modified-Since") == last_modified):
+                status = 304
+                self.send_response(status)
+                self.send_header("ETag", etag)
+                self.end_headers()
+            else:
+                status = 200
+                self.send_response(status)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        with server.lock:
+            server.statuses.append((self.path, status))
+
+    def log_message(self, format, *args):
+        pass  # 不输出访问日志
+
+
+def start_fake_source_server(sources, host="127.0.0.1", port=0):
+    """在后台线程中启动桩服务器，sources 为 {路径 -> 正文字节}，返回服务器实例（用完后调用 shutdown()）"""
+    server = FakeSourceServer(host, port)
+    for path, body in sources.items():
+        server.set_source(path, body)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_merge_rules():
+    """
+    在临时目录中对桩服务器运行三次 merge_rules.main()，检查:
+    首次运行全部下载并生成输出；上游未变化时全部返回 304 且不重写输出文件；某个上游更新后只重新下载该上游并重新合并。
+    """
+    import merge_rules
+
+    server = start_fake_source_server({
+        "/a.txt": b"! source a\n||ads.example.com^\n0.0.0.0 Tracker.Example.net\n",
+        "/b.txt": b"! source b\n||ADS.example.com\n||cdn.example.org^\n",
+    })
+    urls = [server.url("/a.txt"), server.url("/b.txt")]
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            output_file = os.path.join(workdir, "beforeall.txt")
+            local_file = os.path.join(workdir, "white.txt")
+            cache_dir = os.path.join(workdir, "source_cache")
+            with open(local_file, "w", encoding="utf-8") as f:
+                f.write("@@||cdn.example.org^\n")
+
+            assert merge_rules.main(urls, output_file, local_file, cache_dir), "首次运行应生成输出"
+            assert [status for _, status in server.statuses] == [200, 200], server.statuses
+            with open(output_file, "r", encoding="utf-8") as f:
+                rules = [line.rstrip("\n") for line in f if not line.startswith("!")]
+            assert rules == ["@@||cdn.example.org^", "||ads.example.com^", "||cdn.example.org^",
+                             "||tracker.example.net^"], rules
+            mtime = os.stat(output_file).st_mtime_ns
+
+            del server.statuses[:]
+            assert not merge_rules.main(urls, output_file, local_file, cache_dir), "上游未变化时应提前退出"
+            assert [status for _, status in server.statuses] == [304, 304], server.statuses
+            assert os.stat(output_file).st_mtime_ns == mtime, "上游未变化时不应重写输出文件"
+
+            del server.statuses[:]
+            server.set_source("/b.txt", b"||cdn.example.org^\n||new.example.org^\n")
+            assert merge_rules.main(urls, output_file, local_file, cache_dir), "上游更新后应重新合并"
+            assert sorted(status for _, status in server.statuses) == [200, 304], server.statuses
+            with open(output_file, "r", encoding="utf-8") as f:
+                assert "||new.example.org^\n" in f.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+    print("merge_rules.py 条件下载检查通过: 首次下载 200，未变化时 304 并提前退出，上游更新后重新合并。")
+
+
+if __name__ == "__main__":
+    check_merge_rules()
@@ -0,0 +1,71 @@
+# geoip_index.py
+# 将 GeoIP 数据库中某个国家的网段一次性载入为有序区间表，用二分查找批量判断IP归属（支持 IPv4 和 IPv6）
+
+from array import array
+from bisect import bisect_right
+import maxminddb
+
+
+def _merge_intervals(intervals):
+    """合并相邻或重叠的 [起始, 结束] 区间，返回 (起始列表, 结束列表)"""
+    starts, ends = [], []
+    for start, end in sorted(intervals):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+class CountryIPIndex:
+    """
+    某个国家的IP区间索引。
+    IPv4 区间以 32 位无符号整数存放在 array 中；IPv6 区间为 128 位整数，存放在有序列表中。
+    """
+
+    def __init__(self, v4_intervals, v6_intervals):
+        v4_starts, v4_ends = _merge_intervals(v4_intervals)
+        self.v4_starts = array("I", v4_starts)
+        self.v4_ends = array("I", v4_ends)
+        self.v6_starts, self.v6_ends = _merge_intervals(v6_intervals)
+
+    @classmethod
+    def load(cls, db_path, iso_code="CN"):
+        """遍历 mmdb 数据库，收集 iso_code 对应国家的全部网段"""
+        v4_intervals, v6_intervals = [], []
+        with maxminddb.open_database(db_path) as reader:
+            for network, record in reader:
+                country = (record or {}).get("country") or {}
+                if country.get("iso_code") != iso_code:
+                    continue
+                interval = (int(network.network_address), int(network.broadcast_address))
+                if network.version == 4:
+                    v4_intervals.append(interval)
+                else:
+                    v6_intervals.append(interval)
+        return cls(v4_intervals, v6_intervals)
+
+    def __len__(self):
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    def match_table(self, table):
+        """批量判断 DomainIPTable，返回至少有一个IP落在索引网段内的域名编号列表；IP直接以整数查找，不经过字符串"""
+        v4_starts, v4_ends = self.v4_starts, self.v4_ends
+        v6_starts, v6_ends = self.v6_starts, self.v6_ends
+        v4_cache, v6_cache = {}, {}  # IP整数值 -> 是否属于该国家
+
+        def contains(value, starts, ends, cache):
+            result = cache.get(value)
+            if result is None:
+                position = bisect_right(starts, value) - 1
+                result = cache[value] = position >= 0 and value <= ends[position]
+            return result
+
+        matched = []
+        for domain_id in table.domain_ids():
+            if (any(contains(value, v4_starts, v4_ends, v4_cache) for value in table.ipv4_values(domain_id))
+                    or any(contains(int.from_bytes(packed, "big"), v6_starts, v6_ends, v6_cache)
+                           for packed in table.ipv6_values(domain_id))):
+                matched.append(domain_id)
+        return matched
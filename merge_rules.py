@@ -1,56 +1,187 @@
 # merge_rules.py
 # 主脚本，负责下载、合并和保存规则
 
-import requests
+import asyncio
+import hashlib
+import heapq
+import json
 import os
+import re
+import tempfile
+import httpx
 from datetime import datetime, timezone, timedelta
-from config import SOURCE_URLS, OUTPUT_FILE, LOCAL_RULE_FILE  # 从 config.py 导入配置
-
-def download_rules(url):
-    """从 URL 下载规则文件，返回规则列表"""
-    response = requests.get(url)
-    if response.status_code == 200:
-        lines = response.text.splitlines()
-        # 提取规则（不以 ! 和#开头的行）
-        rules = []
-        for line in lines:
-            if not line.startswith('!') and not line.startswith('#'):
-                # 转换 0.0.0.0 或 127.0.0.1 开头的规则为 AdGuard 格式
-                if line.startswith('0.0.0.0 ') or line.startswith('127.0.0.1 '):
-                    domain = line.split(' ', 1)[1].strip()
-                    rules.append(f'||{domain}')
-                else:
-                    rules.append(line)
-        return rules
-    else:
-        raise Exception(f"Failed to download rules from {url}")
-
-def load_local_rules(filepath):
-    """从本地文件加载规则"""
-    if os.path.exists(filepath):
-        with open(filepath, 'r', encoding='utf-8') as file:
-            lines = file.read().splitlines()
-            # 提取规则
-            rules = []
-            for line in lines:
-                if not line.startswith('!') and not line.startswith('#'):
-                    # 转换 0.0.0.0 或 127.0.0.1 开头的规则为 AdGuard 格式
-                    if line.startswith('0.0.0.0 ') or line.startswith('127.0.0.1 '):
-                        domain = line.split(' ', 1)[1].strip()
-                        rules.append(f'||{domain}')
-                    else:
-                        rules.append(line)
-            return rules
+from config import (SOURCE_URLS, OUTPUT_FILE, LOCAL_RULE_FILE,  # 从 config.py 导入配置
+                    SOURCE_CACHE_DIR, DOWNLOAD_TIMEOUT, DOWNLOAD_MAX_CONNECTIONS, MERGE_MAX_RULES_IN_MEMORY)
+
+STATE_FILE = "state.json"  # 上次合并时的输入指纹，保存在 SOURCE_CACHE_DIR 中
+HOSTS_ADDRESSES = ('0.0.0.0', '127.0.0.1')  # hosts 写法的屏蔽地址
+HOSTS_IGNORED_NAMES = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', '0.0.0.0'}  # hosts 文件中的系统条目
+DOMAIN_RULE = re.compile(r'(@@)?\|\|([A-Za-z0-9_.-]+)\^?(\$.*)?')  # 纯域名规则，可带修饰符
+
+def normalize_rule_line(line):
+    """
+    将一行规则转换为规范形式，逐条产出（hosts 写法的一行可能包含多个域名）：
+    - 忽略空行和以 ! 或 # 开头的注释行；
+    - hosts 写法（0.0.0.0/127.0.0.1 加空格或制表符分隔的域名）转换为 ||域名^，行尾的 # 注释被忽略；
+    - ||Example.com 与 ||example.com^ 等纯域名规则统一为小写域名并以 ^ 结尾，修饰符保持不变；
+    - 其他规则去除首尾空白后原样保留。
+    """
+    line = line.strip()
+    if not line or line.startswith('!') or line.startswith('#'):
+        return
+    fields = line.split()
+    if fields[0] in HOSTS_ADDRESSES:
+        for name in fields[1:]:
+            if name.startswith('#'):
+                break
+            name = name.lower()
+            if name not in HOSTS_IGNORED_NAMES:
+                yield f'||{name}^'
+        return
+    match = DOMAIN_RULE.fullmatch(line)
+    if match:
+        yield f"{match[1] or ''}||{match[2].lower()}^{match[3] or ''}"
     else:
-        print(f"本地规则文件 {filepath} 不存在，跳过加载。")
-        return []
+        yield line
+
+def iter_rules_file(filepath):
+    """逐行读取规则文件，产出规范化后的规则，不把整个文件读入内存"""
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            yield from normalize_rule_line(line)
+
+def source_cache_paths(url, cache_dir):
+    """返回某个上游的正文缓存和元数据（ETag/Last-Modified）文件路径"""
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key}.txt"), os.path.join(cache_dir, f"{key}.json")
+
+async def fetch_source(client, url, cache_dir):
+    """
+    条件下载单个上游规则文件，带上缓存的 ETag/If-Modified-Since，正文以流式写入缓存目录。
+    返回: (str: 规则正文文件路径, bool: 是否未修改并使用了本地缓存)
+    """
+    body_path, meta_path = source_cache_paths(url, cache_dir)
+    headers = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    async with client.stream('GET', url, headers=headers) as response:
+        if response.status_code == 304:
+            return body_path, True
+        if response.status_code != 200:
+            raise Exception(f"Failed to download rules from {url}")
+
+        # 先写入临时文件，下载完整后再替换，避免中断时留下不完整的缓存
+        tmp_path = body_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+        os.replace(tmp_path, body_path)
+        with open(meta_path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }, file)
+    return body_path, False
+
+async def fetch_all_sources(urls, cache_dir):
+    """使用连接池并发下载所有上游，返回与 urls 顺序一致的 [(规则正文文件路径, 是否未修改)] 列表"""
+    os.makedirs(cache_dir, exist_ok=True)
+    limits = httpx.Limits(max_connections=DOWNLOAD_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(limits=limits, timeout=DOWNLOAD_TIMEOUT, follow_redirects=True) as client:
+        return await asyncio.gather(*(fetch_source(client, url, cache_dir) for url in urls))
+
+def file_sha256(filepath):
+    """分块计算文件的 SHA-256 摘要"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def compute_input_fingerprint(urls, paths, local_filepath):
+    """计算所有上游正文文件和本地规则文件的联合指纹，用于判断输入是否发生变化"""
+    digest = hashlib.sha256()
+    for url, path in zip(urls, paths):
+        digest.update(url.encode('utf-8'))
+        digest.update(file_sha256(path))
+    if os.path.exists(local_filepath):
+        digest.update(file_sha256(local_filepath))
+    return digest.hexdigest()
+
+def load_previous_fingerprint(cache_dir):
+    """读取上次合并时保存的输入指纹"""
+    state_path = os.path.join(cache_dir, STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r', encoding='utf-8') as file:
+        return json.load(file).get('fingerprint')
 
-def merge_and_deduplicate_rules(rules_list):
-    """合并并去重规则"""
+def save_fingerprint(cache_dir, fingerprint):
+    """保存本次合并的输入指纹"""
+    with open(os.path.join(cache_dir, STATE_FILE), 'w', encoding='utf-8') as file:
+        json.dump({'fingerprint': fingerprint, 'time': get_beijing_time()}, file)
+
+def set_github_output(name, value):
+    """在 GitHub Actions 中设置步骤输出，供后续步骤判断是否需要运行"""
+    output_path = os.environ.get('GITHUB_OUTPUT')
+    if output_path:
+        with open(output_path, 'a', encoding='utf-8') as file:
+            file.write(f"{name}={value}\n")
+
+def spill_sorted_run(rules, run_dir, index):
+    """将一批规则排序后写入临时文件，返回文件路径"""
+    run_path = os.path.join(run_dir, f"run{index}.txt")
+    with open(run_path, 'w', encoding='utf-8', buffering=1 << 20) as file:
+        for rule in sorted(rules):
+            file.write(rule + '\n')
+    return run_path
+
+def iter_sorted_run(run_path):
+    """逐行读取一个已排序的临时文件"""
+    with open(run_path, 'r', encoding='utf-8', buffering=1 << 20) as file:
+        for line in file:
+            yield line[:-1]
+
+def merge_and_deduplicate_rules(rules_list, run_dir, max_rules=MERGE_MAX_RULES_IN_MEMORY):
+    """
+    合并并去重规则，按排序顺序逐条产出。
+    rules_list 中的每个元素都是可迭代的规则序列；内存中的去重集合达到 max_rules 条时排序写入 run_dir 下的临时文件，
+    最后多路归并所有临时文件，内存占用与输入总量无关。
+    """
     combined_rules = set()
+    run_paths = []
     for rules in rules_list:
-        combined_rules.update(rules)  # 使用集合去重
-    return sorted(combined_rules)  # 返回排序后的规则列表
+        for rule in rules:
+            combined_rules.add(rule)  # 使用集合去重
+            if len(combined_rules) >= max_rules:
+                run_paths.append(spill_sorted_run(combined_rules, run_dir, len(run_paths)))
+                combined_rules = set()
+    if not run_paths:
+        yield from sorted(combined_rules)
+        return
+    if combined_rules:
+        run_paths.append(spill_sorted_run(combined_rules, run_dir, len(run_paths)))
+        combined_rules = None
+    previous = None
+    for rule in heapq.merge(*(iter_sorted_run(path) for path in run_paths)):
+        if rule != previous:  # 不同临时文件中的相同规则在归并后相邻
+            yield rule
+            previous = rule
+
+def count_rules(rules, description):
+    """透传规则序列，读取完毕后输出其中的规则数"""
+    count = 0
+    for rule in rules:
+        count += 1
+        yield rule
+    print(f"{description}，行数: {count}")
 
 def get_beijing_time():
     """获取当前北京时间"""
@@ -59,50 +190,78 @@ def get_beijing_time():
     return beijing_time.strftime('%Y-%m-%d %H:%M:%S')
 
 def save_rules_to_file(rules, filename):
-    """将规则保存到文件"""
-    with open(filename, 'w', encoding='utf-8') as file:
-        # 写入自定义前缀信息
-        file.write("! Title: cloudyun-AD-rules\n")
-        file.write(f"! Version: {get_beijing_time()}\n")  # 使用当前北京时间作为版本号
-        file.write(f"! Homepage: https://github.com/cloudyun233/cloudyun-AD-rules\n")
-        file.write(f"! Total lines: {len(rules)}\n")
-        # 写入规则
+    """
+    将规则保存到文件。rules 可以是只能遍历一次的迭代器：
+    规则先写入临时文件并计数，再连同文件头一起复制到目标文件。
+    """
+    body_path = filename + '.body'
+    total = 0
+    with open(body_path, 'w', encoding='utf-8', buffering=1 << 20) as body:
         for rule in rules:
-            file.write(rule + '\n')
+            body.write(rule + '\n')
+            total += 1
+    try:
+        with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as file:
+            # 写入自定义前缀信息
+            file.write("! Title: cloudyun-AD-rules\n")
+            file.write(f"! Version: {get_beijing_time()}\n")  # 使用当前北京时间作为版本号
+            file.write(f"! Homepage: https://github.com/cloudyun233/cloudyun-AD-rules\n")
+            file.write(f"! Total lines: {total}\n")
+            # 写入规则
+            with open(body_path, 'r', encoding='utf-8') as body:
+                for chunk in iter(lambda: body.read(1 << 20), ''):
+                    file.write(chunk)
+    finally:
+        os.remove(body_path)
 
 def print_file_line_count(filename, description):
     """输出文件的行数"""
     with open(filename, 'r', encoding='utf-8') as file:
-        line_count = len(file.readlines())
+        line_count = sum(1 for _ in file)
     print(f"{description} 行数: {line_count}")
 
-def main():
+def main(urls=SOURCE_URLS, output_file=OUTPUT_FILE, local_filepath=LOCAL_RULE_FILE, cache_dir=SOURCE_CACHE_DIR):
+    """
+    下载、合并并保存规则。
+    返回: bool: 输入是否发生变化（未变化时不会重写输出文件，后续的 dispose.py 可以跳过）
+    """
     try:
-        # 下载所有源规则
-        rules_list = []
-        for url in SOURCE_URLS:
-            rules = download_rules(url)
-            rules_list.append(rules)
-            print(f"已下载规则：{url}，行数: {len(rules)}")
+        # 并发下载所有源规则
+        fetched = asyncio.run(fetch_all_sources(urls, cache_dir))
+        paths = [path for path, _ in fetched]
+        for url, (path, not_modified) in zip(urls, fetched):
+            print(f"{'未修改，使用缓存' if not_modified else '已下载规则'}：{url}")
 
-        # 加载本地规则
-        local_rules = load_local_rules(LOCAL_RULE_FILE)
-        if local_rules:
-            rules_list.append(local_rules)
-            print(f"已加载本地规则：{LOCAL_RULE_FILE}，行数: {len(local_rules)}")
+        # 所有上游和本地规则都未变化时直接退出
+        fingerprint = compute_input_fingerprint(urls, paths, local_filepath)
+        if os.path.exists(output_file) and fingerprint == load_previous_fingerprint(cache_dir):
+            print(f"所有上游规则和 {local_filepath} 均未变化，跳过合并。")
+            return False
+
+        # 逐行规范化各上游规则
+        rules_list = [count_rules(iter_rules_file(path), f"已解析规则：{url}") for url, path in zip(urls, paths)]
 
-        # 合并并去重
-        merged_rules = merge_and_deduplicate_rules(rules_list)
+        # 加载本地规则
+        if os.path.exists(local_filepath):
+            rules_list.append(count_rules(iter_rules_file(local_filepath), f"已加载本地规则：{local_filepath}"))
+        else:
+            print(f"本地规则文件 {local_filepath} 不存在，跳过加载。")
 
-        # 保存到文件
-        save_rules_to_file(merged_rules, OUTPUT_FILE)
+        # 合并、去重并保存到文件，超出内存上限的部分暂存在临时目录中
+        with tempfile.TemporaryDirectory(dir=cache_dir) as run_dir:
+            merged_rules = merge_and_deduplicate_rules(rules_list, run_dir)
+            save_rules_to_file(merged_rules, output_file)
+        save_fingerprint(cache_dir, fingerprint)
 
         # 输出结果文件的行数
-        print_file_line_count(OUTPUT_FILE, f"{OUTPUT_FILE} 文件")
-        print(f"规则已合并、去重，并保存到 {OUTPUT_FILE}")
+        print_file_line_count(output_file, f"{output_file} 文件")
+        print(f"规则已合并、去重，并保存到 {output_file}")
+        return True
 
     except Exception as e:
         print(f"发生错误：{e}")
+        return True
 
 if __name__ == "__main__":
-    main()
+    changed = main()
+    set_github_output('changed', 'true' if changed else 'false')
@@ -0,0 +1,142 @@
+# metrics.py
+# 运行指标：各阶段耗时，以及每个DNS服务器的查询数、延迟分布和按类别统计的错误数，导出为 JSON 文件
+
+import json
+import math
+import sys
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+STATUSES = ("ok", "nxdomain", "empty", "timeout", "servfail", "error", "abandoned")  # 查询状态类别，abandoned 为未应答即被取消的查询
+
+# 延迟直方图的桶：从 0.1 毫秒起按 2 的 1/4 次方递增（相邻桶相差约 19%），最后一个桶收纳更慢的查询
+HISTOGRAM_BASE = 0.0001
+HISTOGRAM_GROWTH = 2 ** 0.25
+HISTOGRAM_BUCKETS = 96
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图，内存占用固定，可跨进程合并；分位数取所在桶的上界"""
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts else [0] * HISTOGRAM_BUCKETS
+
+    def record(self, seconds):
+        if seconds <= HISTOGRAM_BASE:
+            index = 0
+        else:
+            index = min(HISTOGRAM_BUCKETS - 1, math.ceil(math.log(seconds / HISTOGRAM_BASE, HISTOGRAM_GROWTH)))
+        self.counts[index] += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, fraction):
+        """返回延迟的分位数（秒），没有样本时返回 None"""
+        total = sum(self.counts)
+        if total == 0:
+            return None
+        rank = math.ceil(total * fraction)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return HISTOGRAM_BASE * HISTOGRAM_GROWTH ** index
+        return HISTOGRAM_BASE * HISTOGRAM_GROWTH ** (HISTOGRAM_BUCKETS - 1)
+
+
+class NameserverMetrics:
+    """单个DNS服务器在某一阶段的查询统计（每次解析含 A 和必要时的 AAAA 查询，计为一次）"""
+
+    def __init__(self):
+        self.queries = 0
+        self.statuses = dict.fromkeys(STATUSES, 0)
+        self.latency = LatencyHistogram()
+
+    def record(self, status, seconds):
+        self.queries += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency.record(seconds)
+
+    def merge(self, other):
+        self.queries += other.queries
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.latency.merge(other.latency)
+
+    def to_state(self):
+        """转为可在进程间传递的简单结构"""
+        return self.queries, self.statuses, self.latency.counts
+
+    @classmethod
+    def from_state(cls, state):
+        metrics = cls()
+        metrics.queries, metrics.statuses, counts = state
+        metrics.latency = LatencyHistogram(counts)
+        return metrics
+
+
+def merge_nameserver_metrics(target, source):
+    """把 {DNS服务器 -> NameserverMetrics} 合并进 target"""
+    for nameserver, metrics in source.items():
+        if nameserver in target:
+            target[nameserver].merge(metrics)
+        else:
+            target[nameserver] = metrics
+
+
+def peak_rss_mb():
+    """
+    返回 (本进程的峰值常驻内存, 已结束子进程中最大的峰值常驻内存)，单位 MB；不支持的平台返回 (None, None)。
+    峰值是进程启动以来的最大值，只增不减。
+    """
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss 在 macOS 上以字节为单位，在 Linux 上以 KB 为单位
+    return tuple(round(resource.getrusage(who).ru_maxrss * scale / (1 << 20), 1)
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def build_report(generated, stage_times, phase_metrics, phase_stages, stage_peak_rss=None):
+    """
+    生成指标报告。
+    phase_metrics 为 {阶段 -> {DNS服务器 -> NameserverMetrics}}；
+    phase_stages 为 {阶段 -> 对应 stage_times 中的耗时键}，用于换算每秒查询数；
+    stage_peak_rss 为 {阶段 -> 该阶段结束时本进程的峰值常驻内存 (MB)}。
+    """
+    report = {"generated": generated, "stages": {stage: round(seconds, 3) for stage, seconds in stage_times.items()},
+              "nameservers": {}}
+    self_mb, children_mb = peak_rss_mb()
+    report["peak_rss_mb"] = {"self": self_mb, "children": children_mb, "stages": stage_peak_rss or {}}
+    for phase, nameservers in phase_metrics.items():
+        wall_time = stage_times.get(phase_stages.get(phase))
+        entries = {}
+        for nameserver, metrics in nameservers.items():
+            entries[nameserver] = {
+                "queries": metrics.queries,
+                "qps": round(metrics.queries / wall_time, 1) if wall_time else None,
+                "latency_ms": {
+                    name: round(value * 1000, 2) if value is not None else None
+                    for name, value in (("p50", metrics.latency.percentile(0.50)),
+                                        ("p95", metrics.latency.percentile(0.95)),
+                                        ("p99", metrics.latency.percentile(0.99)))
+                },
+                "statuses": metrics.statuses,
+            }
+        report["nameservers"][phase] = entries
+    return report
+
+
+def save_report(path, report):
+    """保存指标报告，失败时只记录日志，不影响规则生成"""
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        logger.info(f"已保存运行指标到文件 {path}。")
+    except Exception as e:
+        logger.error(f"保存运行指标文件 {path} 失败: {e}")
@@ -0,0 +1,65 @@
+# recheck_scheduler.py
+# 增量模式的复查调度：根据每个域名的历史结论决定本次需要重新解析哪些域名，
+# 结论长期稳定的域名按指数退避延长复查间隔，新增域名和结论刚变化过的域名优先复查，总量受每次运行的预算限制
+
+from snapshot import FLAG_CHINA_CHECKED, FLAG_CHINA_VALID, FLAG_GLOBAL_CHECKED
+
+SECONDS_PER_DAY = 86400
+UNKNOWN_VERDICT = -1  # 尚未得出过结论的域名
+
+
+def is_conclusive(flags):
+    """解析结论是否完整：国内DNS已得出结论，且国内DNS解析成功或国外DNS也已得出结论"""
+    return bool(flags & FLAG_CHINA_CHECKED) and bool(flags & (FLAG_CHINA_VALID | FLAG_GLOBAL_CHECKED))
+
+
+def recheck_interval(streak, flapping_streak, base_days, max_days):
+    """连续相同结论次数为 streak 的域名的复查间隔（秒）；结论尚未稳定（streak 小于 flapping_streak）时为 0"""
+    if streak < flapping_streak:
+        return 0
+    return min(max_days, base_days * 2 ** (streak - flapping_streak)) * SECONDS_PER_DAY
+
+
+def plan_rechecks(domains, state, now, budget, flapping_streak, base_days, max_days, tolerance=0):
+    """
+    选出本次需要重新解析的域名。
+    domains 为本次的全部域名；state 为快照 {域名 -> (标志位, IP地址, 结论, 连续相同结论次数, 上次复查时间, 上次复查时结论是否变化)}。
+    优先级: 新增或结论不完整的域名 > 上次复查时结论发生变化的域名 > 复查次数不足、结论尚未稳定的域名 >
+    已到复查时间的稳定域名；未到复查时间的稳定域名不复查。每一类中按上次复查时间从早到晚排列，
+    预算不足时各域名轮流得到复查。tolerance 为判断是否到期时允许提前的秒数，避免定时任务略早触发时复查推迟一个周期。
+    budget 为本次最多解析的域名数，为 None 或 0 时不限。
+    返回: (set: 需要重新解析的域名集合, dict: 各类域名的数量)
+    """
+    new, changed, young, due = [], [], [], []
+    for domain in domains:
+        entry = state.get(domain)
+        if entry is None or not is_conclusive(entry[0]) or entry[2] == UNKNOWN_VERDICT:
+            new.append((entry[4] if entry is not None else 0, domain))
+            continue
+        _, _, _, streak, checked, verdict_changed = entry
+        if verdict_changed:
+            changed.append((checked, domain))
+            continue
+        interval = recheck_interval(streak, flapping_streak, base_days, max_days)
+        if interval == 0:
+            young.append((checked, domain))
+        elif now - checked >= interval - tolerance:
+            due.append((checked, domain))
+    candidates = [domain for group in (new, changed, young, due) for _, domain in sorted(group)]
+    selected = candidates[:budget] if budget else candidates
+    stats = {"new": len(new), "changed": len(changed), "young": len(young), "due": len(due),
+             "selected": len(selected), "deferred": len(candidates) - len(selected)}
+    return set(selected), stats
+
+
+def update_history(entry, verdict, checked_now, now):
+    """
+    更新单个域名的历史。entry 为快照中的旧记录（新域名为 None），verdict 为本次的输出结论，
+    checked_now 表示本次是否重新解析并得出了完整结论；未复查的域名沿用旧记录。
+    返回: (结论, 连续相同结论次数, 上次复查时间, 本次复查时结论是否相对上次结论变化)
+    """
+    if not checked_now:
+        return entry[2:] if entry is not None else (UNKNOWN_VERDICT, 0, 0, False)
+    if entry is not None and entry[2] == verdict:
+        return verdict, entry[3] + 1, now, False
+    return verdict, 1, now, entry is not None and entry[2] != UNKNOWN_VERDICT
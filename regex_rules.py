@@ -0,0 +1,224 @@
+# regex_rules.py
+# 编译正则规则（/.../ 及其 $dnstype、$denyallow 修饰符），批量判断哪些域名已被正则黑名单规则完全覆盖
+
+import re
+
+LITERAL_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_")
+MIN_LITERAL_LENGTH = 3  # 预筛选字面量的最短长度，更短的字面量区分度太低
+INLINE_FLAGS = re.compile(r"\(\?[aiLmsux-]+[:)]")  # (?i) (?i:...) 等内联修饰符，可能改变字面量的匹配方式
+ESCAPE_ARGUMENT = re.compile(r"x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}|[0-9]{1,3}")  # 转义及其参数
+REPEAT = re.compile(r"\{\d*(,\d*)?\}")  # {m,n} 计数量词
+SUBDOMAIN_PREFIXES = ("^(\\S+\\.)?", "^(.*\\.)?", "^(.+\\.)?", "^([^.]+\\.)*")  # 同时匹配任意子域名的开头写法
+COVERING_MODIFIERS = frozenset(("important", "denyallow"))  # 不影响覆盖判断（或可单独处理）的修饰符
+
+
+def parse_regex_rule(rule):
+    """
+    拆分正则规则。
+    返回: (bool: 是否为白名单规则, str: 正则表达式, dict: {修饰符 -> 值})；不是正则规则时返回 None
+    """
+    is_allow = rule.startswith("@@")
+    body = rule[2:] if is_allow else rule
+    if not body.startswith("/"):
+        return None
+    end = body.rfind("/")
+    while end > 0 and body[end + 1:] and not body[end + 1:].startswith("$"):
+        end = body.rfind("/", 0, end)  # 正则内部的 /，继续向前查找
+    if end <= 0:
+        return None
+    modifiers = {}
+    for option in filter(None, body[end + 2:].split(",")):
+        name, _, value = option.partition("=")
+        modifiers[name] = value
+    return is_allow, body[1:end], modifiers
+
+
+def required_literal(pattern):
+    """
+    提取任何匹配都必须包含的最长字面量，用于在运行正则前快速排除域名。
+    只考虑最外层、不带可选量词的普通字符；\x41、\101 等转义和 {m,n} 中的数字都不算字面量。
+    最外层存在 |、带有内联修饰符或找不到足够长的字面量时返回 None。
+    """
+    if INLINE_FLAGS.search(pattern):
+        return None
+    runs = []
+    current = []
+    depth = 0
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        literal = None
+        if char == "\\" and index + 1 < length:
+            escaped = pattern[index + 1]
+            if not escaped.isalnum():  # \. \- 等转义的普通字符；\d \S 等字符类不是字面量
+                literal = escaped
+                index += 2
+            else:  # \x61 \u0061 \N{...} 八进制和反向引用连同参数整体跳过
+                argument = ESCAPE_ARGUMENT.match(pattern, index + 1)
+                index = argument.end() if argument else index + 2
+        elif char == "{":  # {m,n} 计数量词整体跳过，其中的数字不是字面量
+            repeat = REPEAT.match(pattern, index)
+            index = repeat.end() if repeat else index + 1
+        elif char == "[":  # 字符类整体跳过
+            index += 1
+            if index < length and pattern[index] == "^":
+                index += 1
+            if index < length and pattern[index] == "]":
+                index += 1
+            while index < length and pattern[index] != "]":
+                index += 2 if pattern[index] == "\\" else 1
+            index += 1
+        elif char == "(":
+            depth += 1
+            index += 1
+            runs.append("".join(current))
+            current = []
+            continue
+        elif char == ")":
+            depth -= 1
+            index += 1
+        elif char == "|":
+            if depth == 0:
+                return None
+            index += 1
+            continue
+        else:
+            if char in LITERAL_CHARS:
+                literal = char
+            index += 1
+        if depth > 0:
+            continue
+
+        # 后跟 ? * {0, 的字符可能不出现；后跟 + {n, 的字符至少出现一次，但其后的内容不再连续
+        quantifier = pattern[index] if index < length else ""
+        optional = quantifier in ("?", "*") or (quantifier == "{" and re.match(r"\{0*(,|\}|,\d*\})", pattern[index:]))
+        if literal is None or optional:
+            runs.append("".join(current))
+            current = []
+            continue
+        current.append(literal)
+        if quantifier in ("+", "{"):
+            runs.append("".join(current))
+            current = []
+    runs.append("".join(current))
+    best = max(runs, key=len)
+    return best if len(best) >= MIN_LITERAL_LENGTH else None
+
+
+def _anchored_at_start(pattern):
+    """
+    判断正则是否依赖域名开头（^、\A 或向后断言），这样的正则匹配某个域名时不一定匹配其子域名。
+    开头的 SUBDOMAIN_PREFIXES 写法同时匹配任意子域名，不算；字符类中的 ^ 和转义的 \^ 也不算。
+    """
+    for prefix in SUBDOMAIN_PREFIXES:
+        if pattern.startswith(prefix):
+            pattern = pattern[len(prefix):]
+            break
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        if char == "\\":
+            if pattern[index + 1:index + 2] == "A":
+                return True
+            index += 2
+        elif char == "[":  # 字符类整体跳过
+            index += 1
+            if index < length and pattern[index] == "^":
+                index += 1
+            if index < length and pattern[index] == "]":
+                index += 1
+            while index < length and pattern[index] != "]":
+                index += 2 if pattern[index] == "\\" else 1
+            index += 1
+        elif char == "^" or pattern.startswith("(?<", index) and not pattern.startswith("(?<P", index):
+            return True
+        else:
+            index += 1
+    return False
+
+
+def _compile_any(patterns):
+    """把多个正则合并为一个，返回其 search 方法；合并失败（如重名分组）时逐个匹配"""
+    try:
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns)).search
+    except re.error:
+        compiled = [re.compile(pattern) for pattern in patterns]
+        return lambda domain: any(regex.search(domain) for regex in compiled)
+
+
+class RegexRuleMatcher:
+    """
+    判断域名是否被正则黑名单规则完全覆盖，即该域名及其所有子域名的全部查询类型都会被某条正则规则拦截。
+    满足条件的正则按必需字面量分组合并编译，匹配时先检查字面量再运行正则；
+    带 $denyallow 的正则排除其放行的域名；带 $dnstype 或其他修饰符的正则只拦截部分查询，不参与覆盖判断；
+    被正则白名单规则匹配的域名不视为被覆盖。
+    """
+
+    def __init__(self, rules):
+        keyed = {}  # 必需字面量 -> [正则]
+        unkeyed = []  # 没有可用字面量的正则
+        allow = []  # 正则白名单规则
+        self.denyallow = []  # [(正则 search 方法, 放行的域名元组)]
+        self.total = 0  # 正则规则总数
+        self.usable = 0  # 参与覆盖判断的正则规则数
+        for rule in rules:
+            parsed = parse_regex_rule(rule)
+            if parsed is None:
+                continue
+            self.total += 1
+            is_allow, pattern, modifiers = parsed
+            try:
+                re.compile(pattern)
+            except re.error:
+                continue
+            if is_allow:
+                allow.append(pattern)
+                continue
+            if not set(modifiers) <= COVERING_MODIFIERS:
+                continue
+            if _anchored_at_start(pattern):
+                continue  # 只匹配域名开头的正则不一定匹配其子域名
+            self.usable += 1
+            if modifiers.get("denyallow"):
+                domains = tuple(d.lower() for d in modifiers["denyallow"].split("|") if d)
+                self.denyallow.append((re.compile(pattern).search, domains))
+                continue
+            literal = required_literal(pattern)
+            if literal is None:
+                unkeyed.append(pattern)
+            else:
+                keyed.setdefault(literal, []).append(pattern)
+        self.keyed = [(literal, _compile_any(patterns)) for literal, patterns in keyed.items()]
+        self.unkeyed = _compile_any(unkeyed) if unkeyed else None
+        self.allow = _compile_any(allow) if allow else None
+
+    def __bool__(self):
+        return self.usable > 0
+
+    def covers(self, domain):
+        """判断单个域名（及其子域名）是否被正则黑名单规则完全覆盖"""
+        if self.allow is not None and self.allow(domain):
+            return False
+        if self.unkeyed is not None and self.unkeyed(domain):
+            return True
+        for literal, search in self.keyed:
+            if literal in domain and search(domain):
+                return True
+        for search, allowed in self.denyallow:
+            if search(domain) and not any(_related(domain, other) for other in allowed):
+                return True
+        return False
+
+    def match_domains(self, domains):
+        """批量判断，返回被正则黑名单规则完全覆盖的域名集合"""
+        if not self:
+            return set()
+        covers = self.covers
+        return {domain for domain in domains if covers(domain)}
+
+
+def _related(domain, other):
+    """两个域名相同或存在上下级关系"""
+    return domain == other or domain.endswith("." + other) or other.endswith("." + domain)
@@ -0,0 +1,139 @@
+# resolve_journal.py
+# 断点续跑日志：按阶段追加记录每个域名的解析结论，运行中断后重新运行时跳过已有结论的域名
+#
+# 日志目录结构:
+#   header.json      输入指纹、输出文件的版本时间、复查调度使用的运行时间
+#   <阶段>.journal    每行一个域名: 域名\t标志位\t逗号分隔的IP地址（标志位: 1 解析成功，2 已得出结论，4 由DNS服务器实际应答）
+#   previous/        开始时保存的上次输出文件，续跑时据此计算沿用结果和变更报告，保证与不中断时的输出一致
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from loguru import logger
+
+ENTRY_VALID = 1  # 解析成功
+ENTRY_CHECKED = 2  # 已得出结论（不是超时或 SERVFAIL）
+ENTRY_ANSWERED = 4  # 由DNS服务器实际应答得出（不是沿用快照或缓存）
+
+
+def input_fingerprint(input_file, *settings):
+    """
+    输入规则和影响解析结论的设置的指纹，指纹不同的日志不能续用。
+    只计算规则正文，跳过 ! 开头的注释行：重新合并时文件头的 Version 时间会变化，但规则不变时仍可续用。
+    """
+    digest = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for line in f:
+            if not line.startswith(b"!"):
+                digest.update(line)
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResolveJournal:
+    """
+    追加写入的解析结论日志。record() 只把结果放入缓冲区，
+    每攒够 flush_size 条或距上次写入超过 flush_interval 秒时一次性写入文件，不拖慢解析循环。
+    """
+
+    def __init__(self, directory, header, flush_size, flush_interval):
+        self.directory = directory
+        self.header = header
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.files = {}  # 阶段 -> 追加模式打开的日志文件
+        self.pending = {}  # 阶段 -> 待写入的行
+        self.pending_count = 0
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def open(cls, directory, fingerprint, header, output_files, flush_size, flush_interval):
+        """
+        打开日志目录。目录中已有指纹相同的日志时续用（返回的 header 为上次保存的内容），否则新建日志，
+        并保存 output_files 中现有的输出文件作为本次运行的“上次输出”。
+        返回: (ResolveJournal, bool: 是否为续跑)
+        """
+        header_path = os.path.join(directory, "header.json")
+        if os.path.exists(header_path):
+            try:
+                with open(header_path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                if saved.get("fingerprint") == fingerprint:
+                    return cls(directory, saved, flush_size, flush_interval), True
+                logger.info(f"断点续跑日志 {directory} 与本次输入不符，重新开始。")
+            except Exception as e:
+                logger.error(f"读取断点续跑日志 {directory} 失败，重新开始: {e}")
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(os.path.join(directory, "previous"))
+        for filename in output_files:
+            if os.path.exists(filename):
+                shutil.copyfile(filename, os.path.join(directory, "previous", os.path.basename(filename)))
+        header = dict(header, fingerprint=fingerprint)
+        tmp_path = header_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(header, f, ensure_ascii=False)
+        os.replace(tmp_path, header_path)  # 上次输出保存完毕后才写入 header，保证续跑时其内容完整
+        return cls(directory, header, flush_size, flush_interval), False
+
+    def previous_path(self, filename):
+        """上次输出文件在日志目录中的副本路径（上次没有该文件时副本也不存在）"""
+        return os.path.join(self.directory, "previous", os.path.basename(filename))
+
+    def load(self, phase):
+        """
+        读取某阶段已记录的结论，忽略中断时写了一半的末行。
+        返回: dict: {域名 -> (是否有效, 是否已得出结论, 是否由DNS服务器实际应答, {IPv4地址集合}, {IPv6地址集合})}
+        """
+        path = os.path.join(self.directory, f"{phase}.journal")
+        results = {}
+        if not os.path.exists(path):
+            return results
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                fields = line[:-1].split("\t")
+                if len(fields) != 3:
+                    continue
+                domain, flags, ips = fields
+                flags = int(flags)
+                ips = ips.split(",") if ips else []
+                results[domain] = (bool(flags & ENTRY_VALID), bool(flags & ENTRY_CHECKED), bool(flags & ENTRY_ANSWERED),
+                                   {ip for ip in ips if ":" not in ip}, {ip for ip in ips if ":" in ip})
+        return results
+
+    def record(self, phase, domain, is_valid, checked, answered, ipv4s, ipv6s):
+        """记录一个域名的结论，按批量写入"""
+        flags = ((ENTRY_VALID if is_valid else 0) | (ENTRY_CHECKED if checked else 0)
+                 | (ENTRY_ANSWERED if answered else 0))
+        self.pending.setdefault(phase, []).append(f"{domain}\t{flags}\t{','.join([*ipv4s, *ipv6s])}\n")
+        self.pending_count += 1
+        if self.pending_count >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区中的结论写入各阶段的日志文件"""
+        for phase, lines in self.pending.items():
+            if not lines:
+                continue
+            f = self.files.get(phase)
+            if f is None:
+                f = self.files[phase] = open(os.path.join(self.directory, f"{phase}.journal"), "a", encoding="utf-8")
+            f.write("".join(lines))
+            f.flush()
+            lines.clear()
+        self.pending_count = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def remove(self):
+        """运行正常结束后删除日志目录"""
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
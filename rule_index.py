@@ -0,0 +1,258 @@
+# rule_index.py
+# 生成规则文件的二进制查询索引（可 mmap 直接加载，无需解析文本），并提供 match/match_many 查询接口
+#
+# 文件格式（小端序）:
+#   文件头     magic(8) 版本 域名条目数 哈希表槽数 域名区字节数 正则区字节数 (各 u32)，补齐到 32 字节
+#   偏移数组   (条目数 + 1) 个 u32，第 i 个域名位于域名区 [offsets[i], offsets[i+1])
+#   标志数组   条目数个 u8 (FLAG_*)，补齐到 4 字节
+#   哈希表     槽数个 u32，按 crc32(反转域名) 开放寻址，值为条目序号 + 1，0 表示空槽
+#   域名区     按字节序排序的反转域名（com.example.www），依次拼接
+#   正则区     JSON: [[正则, 修饰符, 是否白名单], ...]，加载时编译
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from regex_rules import parse_regex_rule, required_literal
+
+MAGIC = b"CYRIDX\x00\x01"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIII")
+HEADER_SIZE = 32
+
+# 域名条目的标志位
+FLAG_BLOCK = 1  # ||域名^
+FLAG_ALLOW = 2  # @@||域名^
+FLAG_BLOCK_IMPORTANT = 4  # ||域名^$important
+FLAG_ALLOW_IMPORTANT = 8  # @@||域名^$important
+
+DOMAIN_RULE = re.compile(r"(@@)?\|\|([^\^$/|]+)\^?(?:\$(.*))?")
+SUPPORTED_MODIFIERS = frozenset(("important", "denyallow", "dnstype"))
+
+
+def reverse_domain(domain):
+    """www.example.com -> com.example.www"""
+    return ".".join(reversed(domain.split(".")))
+
+
+def _rule_flag(is_allow, modifiers):
+    if is_allow:
+        return FLAG_ALLOW_IMPORTANT if "important" in modifiers else FLAG_ALLOW
+    return FLAG_BLOCK_IMPORTANT if "important" in modifiers else FLAG_BLOCK
+
+
+def _parse_modifiers(text):
+    modifiers = {}
+    for option in filter(None, (text or "").split(",")):
+        name, _, value = option.partition("=")
+        modifiers[name] = value
+    return modifiers
+
+
+def build_index(rules, path):
+    """
+    由规则文本生成索引文件。
+    不带修饰符（或只带 $important）的域名规则进入域名区；正则规则和带 $denyallow/$dnstype 的域名规则进入正则区；
+    带其他修饰符的规则和其他写法的规则不影响 DNS 层面的拦截判断，不写入索引。
+    返回: (int: 域名条目数, int: 正则条目数)
+    """
+    entries = {}  # 反转域名 -> 标志位
+    patterns = []  # [正则, 修饰符, 是否白名单]
+    for rule in rules:
+        parsed = parse_regex_rule(rule)
+        if parsed is not None:
+            is_allow, pattern, modifiers = parsed
+            if set(modifiers) <= SUPPORTED_MODIFIERS:
+                patterns.append([pattern, modifiers, is_allow])
+            continue
+        match = DOMAIN_RULE.fullmatch(rule)
+        if not match:
+            continue
+        is_allow, domain, modifiers = bool(match[1]), match[2].lower(), _parse_modifiers(match[3])
+        if not set(modifiers) <= SUPPORTED_MODIFIERS:
+            continue
+        if "*" in domain or set(modifiers) - {"important"}:
+            # 通配符或带限定条件的域名规则转换为等价正则
+            body = ".*".join(re.escape(part) for part in domain.split("*"))
+            patterns.append([rf"(^|\.){body}$", modifiers, is_allow])
+            continue
+        key = reverse_domain(domain)
+        entries[key] = entries.get(key, 0) | _rule_flag(is_allow, modifiers)
+
+    keys = sorted(key.encode("utf-8") for key in entries)
+    offsets = array("I", [0])
+    flags = bytearray()
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+        flags.append(entries[key.decode("utf-8")])
+    table_size = 1
+    while table_size < len(keys) * 2:
+        table_size <<= 1
+    mask = table_size - 1
+    table = array("I", bytes(4 * table_size))
+    for index, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = index + 1
+    if sys.byteorder == "big":
+        offsets.byteswap()
+        table.byteswap()
+    blob = b"".join(keys)
+    regex_section = json.dumps(patterns, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys), table_size, len(blob), len(regex_section)).ljust(HEADER_SIZE, b"\0"))
+        f.write(offsets.tobytes())
+        f.write(bytes(flags) + b"\0" * (-len(flags) % 4))
+        f.write(table.tobytes())
+        f.write(blob)
+        f.write(regex_section)
+    os.replace(tmp_path, path)
+    return len(keys), len(patterns)
+
+
+class RuleIndex:
+    """
+    以 mmap 方式打开索引文件，按 AdGuard DNS 规则的优先级判断域名是否被拦截：
+    $important 白名单 > $important 黑名单 > 白名单 > 黑名单。
+    域名规则同时匹配域名本身及其子域名。
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, table_size, blob_size, regex_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f"不是有效的规则索引文件: {path}")
+        view = memoryview(self.mm)
+        position = HEADER_SIZE
+        offsets = view[position:position + 4 * (count + 1)]
+        position += 4 * (count + 1)
+        self.flags = view[position:position + count]
+        position += count + (-count % 4)
+        table = view[position:position + 4 * table_size]
+        position += 4 * table_size
+        self.blob = view[position:position + blob_size]
+        position += blob_size
+        patterns = json.loads(bytes(view[position:position + regex_size]).decode("utf-8"))
+        if sys.byteorder == "big":  # 大端平台复制一份并转换字节序
+            offsets = array("I", offsets.tobytes())
+            offsets.byteswap()
+            table = array("I", table.tobytes())
+            table.byteswap()
+        else:
+            offsets = offsets.cast("I")
+            table = table.cast("I")
+        self.offsets = offsets
+        self.table = table
+        self.mask = table_size - 1
+        self.count = count
+        # 正则按必需字面量分组：先用所有字面量合并成的正则判断域名是否包含任一字面量，多数域名一次即可排除
+        keyed = {}  # 必需字面量 -> [正则条目]
+        self.unkeyed = []  # 没有可用字面量的正则条目，总是运行
+        for pattern, modifiers, is_allow in patterns:
+            literal = required_literal(pattern)
+            entry = self.__compile(pattern, modifiers, is_allow)
+            if literal is None:
+                self.unkeyed.append(entry)
+            else:
+                keyed.setdefault(literal, []).append(entry)
+        self.keyed = list(keyed.items())
+        self.regex_count = len(patterns)
+        self.literal_search = None
+        if keyed:
+            self.literal_search = re.compile("|".join(re.escape(literal) for literal in keyed)).search
+
+    @staticmethod
+    def __compile(pattern, modifiers, is_allow):
+        """返回 (search 方法, 标志位, denyallow 域名元组, (允许的查询类型, 排除的查询类型))"""
+        try:
+            search = re.compile(pattern).search
+        except re.error:
+            search = lambda domain: None  # 无法编译的正则不匹配任何域名
+        denyallow = tuple(d.lower() for d in modifiers.get("denyallow", "").split("|") if d)
+        dnstypes = None
+        if "dnstype" in modifiers:
+            types = [t.upper() for t in modifiers["dnstype"].split("|") if t]
+            dnstypes = ({t for t in types if not t.startswith("~")}, {t[1:] for t in types if t.startswith("~")})
+        return search, _rule_flag(is_allow, modifiers), denyallow, dnstypes
+
+    def __len__(self):
+        return self.count + self.regex_count
+
+    def close(self):
+        self.offsets = self.table = self.flags = self.blob = None
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __domain_flags(self, reversed_key):
+        """合并反转域名及其各级上级域名命中的标志位"""
+        table, offsets, blob, flags, mask = self.table, self.offsets, self.blob, self.flags, self.mask
+        combined = 0
+        end = reversed_key.find(b".")
+        while True:
+            key = reversed_key if end < 0 else reversed_key[:end]
+            slot = zlib.crc32(key) & mask
+            while True:
+                entry = table[slot]
+                if not entry:
+                    break
+                if blob[offsets[entry - 1]:offsets[entry]] == key:
+                    combined |= flags[entry - 1]
+                    break
+                slot = (slot + 1) & mask
+            if end < 0:
+                return combined
+            end = reversed_key.find(b".", end + 1)
+
+    def __regex_flags(self, domain, dnstype):
+        """合并域名命中的正则规则的标志位"""
+        entries = self.unkeyed
+        if self.literal_search is not None and self.literal_search(domain):
+            entries = entries + [entry for literal, group in self.keyed if literal in domain for entry in group]
+        combined = 0
+        for search, flag, denyallow, dnstypes in entries:
+            if not search(domain):
+                continue
+            if denyallow and any(domain == d or domain.endswith("." + d) for d in denyallow):
+                continue
+            if dnstypes is not None:
+                included, excluded = dnstypes
+                if dnstype is None or dnstype.upper() in excluded or (included and dnstype.upper() not in included):
+                    continue
+            combined |= flag
+        return combined
+
+    def match(self, domain, dnstype=None):
+        """
+        判断域名是否被拦截。dnstype 为查询类型（如 "A"、"AAAA"），
+        为 None 时带 $dnstype 限定的规则不参与判断。
+        """
+        domain = domain.lower().rstrip(".")
+        combined = self.__domain_flags(reverse_domain(domain).encode("utf-8"))
+        if self.regex_count:
+            combined |= self.__regex_flags(domain, dnstype)
+        if combined & FLAG_ALLOW_IMPORTANT:
+            return False
+        if combined & FLAG_BLOCK_IMPORTANT:
+            return True
+        if combined & FLAG_ALLOW:
+            return False
+        return bool(combined & FLAG_BLOCK)
+
+    def match_many(self, domains, dnstype=None):
+        """批量判断，返回与 domains 顺序一致的布尔值列表"""
+        match = self.match
+        return [match(domain, dnstype) for domain in domains]
@@ -0,0 +1,59 @@
+# snapshot.py
+# 上次运行的域名集合、解析结论与复查历史快照（gzip 压缩的 JSON），供增量模式使用
+
+import gzip
+import json
+import os
+from loguru import logger
+
+SNAPSHOT_VERSION = 3
+
+# 每个域名的结论标志位
+FLAG_CHINA_CHECKED = 1  # 已经过国内DNS解析
+FLAG_CHINA_VALID = 2  # 国内DNS解析成功
+FLAG_GLOBAL_CHECKED = 4  # 已经过国外DNS解析
+FLAG_GLOBAL_VALID = 8  # 国外DNS解析成功
+
+
+def load_snapshot(path):
+    """
+    读取快照。
+    返回: dict: {域名 -> (标志位, 逗号分隔的IP地址, 结论, 连续相同结论次数, 上次复查时间, 上次复查时结论是否变化)}；快照不存在或无法读取时返回 None
+    IP地址保持为一个字符串，用到时再拆分，避免为每个域名常驻一个集合
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"快照版本不匹配，忽略快照文件 {path}")
+            return None
+        return {
+            domain: (flags, ips, verdict, streak, checked_time, bool(changed))
+            for domain, flags, ips, verdict, streak, checked_time, changed
+            in zip(data["domains"], data["flags"], data["ips"], data["verdicts"], data["streaks"], data["checked"],
+                   data["changed"])
+        }
+    except Exception as e:
+        logger.error(f"读取快照文件 {path} 失败: {e}")
+        return None
+
+
+def save_snapshot(path, state):
+    """保存快照，state 为 {域名 -> (标志位, IP地址字符串列表, 结论, 连续相同结论次数, 上次复查时间, 上次复查时结论是否变化)}"""
+    domains = sorted(state)
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "domains": domains,
+        "flags": [state[domain][0] for domain in domains],
+        "ips": [",".join(sorted(state[domain][1])) for domain in domains],
+        "verdicts": [state[domain][2] for domain in domains],
+        "streaks": [state[domain][3] for domain in domains],
+        "checked": [state[domain][4] for domain in domains],
+        "changed": [int(state[domain][5]) for domain in domains],
+    }
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
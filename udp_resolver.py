@@ -0,0 +1,221 @@
+# udp_resolver.py
+# 基于原始 UDP 的批量DNS查询引擎：少量长连接套接字、A/AAAA 并行查询、按查询ID匹配响应、自行重传
+
+import asyncio
+import random
+import socket
+import struct
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+
+def encode_question(domain, qtype):
+    """构造问题段（域名 + 类型 + IN 类），域名非法时抛出 ValueError"""
+    parts = []
+    for label in domain.rstrip(".").split("."):
+        try:
+            raw = label.encode("ascii")
+        except UnicodeEncodeError:
+            raw = label.encode("idna")
+        if not raw or len(raw) > 63:
+            raise ValueError(f"invalid label in {domain!r}")
+        parts.append(bytes((len(raw),)) + raw)
+    return b"".join(parts) + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def build_query(qid, question):
+    """构造带 RD 标志的查询报文"""
+    return struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) + question
+
+
+def skip_name(buf, offset):
+    """跳过报文中的一个域名（支持压缩指针），返回其后的偏移"""
+    while True:
+        length = buf[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def parse_response(buf, question):
+    """
+    解析响应报文。
+    返回: (int: 响应码, list: [(记录类型, TTL, 记录数据)])；问题段与查询不一致时返回 None
+    """
+    if len(buf) < 12 + len(question):
+        return None
+    _, flags, qdcount, ancount, _, _ = struct.unpack_from("!HHHHHH", buf, 0)
+    if qdcount != 1 or buf[12:12 + len(question)].lower() != question.lower():
+        return None
+    offset = 12 + len(question)
+    records = []
+    for _ in range(ancount):
+        offset = skip_name(buf, offset)
+        rtype, _, ttl, rdlength = struct.unpack_from("!HHIH", buf, offset)
+        offset += 10
+        records.append((rtype, ttl, buf[offset:offset + rdlength]))
+        offset += rdlength
+    return flags & 0x000F, records
+
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver, index):
+        self.resolver = resolver
+        self.index = index
+
+    def datagram_received(self, data, addr):
+        self.resolver._on_response(self.index, data)
+
+    def error_received(self, exc):
+        pass  # ICMP 错误由重传计时器兜底
+
+
+class UDPResolver:
+    """
+    面向单个DNS服务器的批量查询客户端。
+    查询按 (套接字, 查询ID) 登记在待响应表中，超时后按原报文重传，超过重试次数记为超时。
+    """
+
+    def __init__(self, nameserver, port, sockets=4, timeout=1.0, retries=3):
+        self.nameserver = nameserver
+        self.port = port
+        self.socket_count = sockets
+        self.timeout = timeout
+        self.retries = retries
+        self.transports = []
+        self.pending = {}  # (套接字序号, 查询ID) -> [future, 问题段, 报文, 已发送次数, 重传计时器]
+        self.next_socket = 0
+        self.opening = None
+
+    async def open(self):
+        """打开全部套接字；任一套接字打开失败时关闭已打开的套接字并抛出 OSError"""
+        loop = asyncio.get_running_loop()
+        transports = []
+        try:
+            for index in range(self.socket_count):
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda index=index: _ResolverProtocol(self, index),
+                    remote_addr=(self.nameserver, self.port),
+                )
+                transports.append(transport)
+        except OSError:
+            for transport in transports:
+                transport.close()
+            raise
+        self.transports = transports
+
+    def close(self):
+        for entry in self.pending.values():
+            if entry[4] is not None:
+                entry[4].cancel()
+            if not entry[0].done():
+                entry[0].cancel()
+        self.pending.clear()
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    async def query(self, domain, qtype):
+        """
+        发送单个查询并等待响应。
+        返回: (str: 状态 ok/nxdomain/empty/timeout/servfail, list: [(记录类型, TTL, 记录数据)])；
+        套接字打开或发送失败（网络不可达、文件描述符耗尽、发送缓冲区已满等）时记为 servfail，交给其他服务器重试
+        """
+        if not self.transports:
+            if self.opening is None:
+                self.opening = asyncio.ensure_future(self.open())
+            opening = self.opening
+            try:
+                await opening
+            except OSError:
+                if self.opening is opening:
+                    self.opening = None  # 下次查询时重新打开
+                return "servfail", []
+        loop = asyncio.get_running_loop()
+        question = encode_question(domain, qtype)
+        index = self.next_socket
+        self.next_socket = (index + 1) % self.socket_count
+        qid = random.getrandbits(16)
+        while (index, qid) in self.pending:
+            qid = random.getrandbits(16)
+        wire = build_query(qid, question)
+        future = loop.create_future()
+        entry = [future, question, wire, 0, None]
+        self.pending[(index, qid)] = entry
+        self.__send(index, qid)
+        try:
+            return await future
+        finally:
+            if entry[4] is not None:
+                entry[4].cancel()
+            self.pending.pop((index, qid), None)
+
+    def __send(self, index, qid):
+        entry = self.pending.get((index, qid))
+        if entry is None or entry[0].done():
+            return
+        if entry[3] >= self.retries:
+            entry[0].set_result(("timeout", []))
+            return
+        entry[3] += 1
+        try:
+            self.transports[index].sendto(entry[2])
+        except OSError:
+            entry[0].set_result(("servfail", []))
+            return
+        entry[4] = asyncio.get_running_loop().call_later(self.timeout, self.__send, index, qid)
+
+    def _on_response(self, index, data):
+        if len(data) < 12:
+            return
+        qid = struct.unpack_from("!H", data, 0)[0]
+        entry = self.pending.get((index, qid))
+        if entry is None or entry[0].done():
+            return
+        try:
+            parsed = parse_response(data, entry[1])
+        except (IndexError, struct.error):
+            parsed = None
+        if parsed is None:
+            return  # 问题段不匹配或报文损坏，继续等待正确的响应
+        rcode, records = parsed
+        if rcode == RCODE_NOERROR:
+            status = "ok" if records else "empty"
+        elif rcode == RCODE_NXDOMAIN:
+            status = "nxdomain"
+        else:
+            status = "servfail"
+        entry[0].set_result((status, records))
+
+    async def resolve(self, domain):
+        """
+        并行查询 A 和 AAAA 记录。
+        返回: (bool: 是否解析成功 A 或 AAAA, set: IPv4地址集合, set: IPv6地址集合, int: 记录TTL, str: 查询状态)
+        """
+        try:
+            (a_status, a_records), (aaaa_status, aaaa_records) = await asyncio.gather(
+                self.query(domain, QTYPE_A), self.query(domain, QTYPE_AAAA)
+            )
+        except ValueError:
+            return False, set(), set(), None, "error"
+        except OSError:  # 网络错误视为上游失败，交给其他服务器重试
+            return False, set(), set(), None, "servfail"
+
+        ipv4s = {socket.inet_ntop(socket.AF_INET, rdata) for rtype, _, rdata in a_records
+                 if rtype == QTYPE_A and len(rdata) == 4}
+        ipv6s = {socket.inet_ntop(socket.AF_INET6, rdata) for rtype, _, rdata in aaaa_records
+                 if rtype == QTYPE_AAAA and len(rdata) == 16}
+        a_ttls = [ttl for rtype, ttl, _ in a_records if rtype == QTYPE_A]
+        aaaa_ttls = [ttl for rtype, ttl, _ in aaaa_records if rtype == QTYPE_AAAA]
+        if a_ttls:
+            return True, ipv4s, ipv6s, min(a_ttls), "ok"
+        if aaaa_ttls:
+            return True, ipv4s, ipv6s, min(aaaa_ttls), "ok"
+        statuses = (a_status, aaaa_status)
+        status = next((s for s in ("timeout", "servfail", "nxdomain") if s in statuses), "empty")
+        return False, set(), set(), None, status